@@ -0,0 +1,139 @@
+import logging
+import time
+
+import serial
+
+
+BASE_RATE       = 921600
+CANDIDATES      = [3000000, 2000000, 1500000, 1000000, BASE_RATE]
+SYNC_TIMEOUT    = 2             # seconds to wait for the device's sync at a new rate
+ERROR_WINDOW    = 1 << 18       # bytes the garbled byte rate is measured over
+ERROR_RATE      = 1e-4          # garbled bytes per byte that make the link fall back a rate
+
+# anything else on the wire means a byte was received wrong
+VALID_BYTES     = bytes(range(0x20, 0x7f)) + b'\t\r\n'
+
+
+class Negotiator:
+    """ Agrees a faster link speed with the device and falls back if it proves unreliable
+
+        The exchange, all '\\n' terminated, uses the device's existing pause:
+
+            device: pause               the device offers a rate change
+            host:   baud <rate>         fastest candidate not yet ruled out
+            device: ok <rate>           both ends switch to <rate>
+                    (or no <rate>)      the host tries the next one down
+            device: sync                sent at the new rate
+            host:   sync                link verified, data resumes
+
+        Without a sync within SYNC_TIMEOUT both ends go back to the previous
+        rate and <rate> is not offered again. While data flows, the share of
+        bytes that can't appear in a .fn file is measured; past ERROR_RATE the
+        host proposes the next rate down itself, which the device answers
+        like any other proposal. The port is put back to its original rate
+        when the session closes.
+    """
+
+    def __init__(self, ser, maxBaud=None, log=logging.info):
+        self.ser            = ser
+        self.log            = log
+        self.baseRate       = ser.baudrate
+        rates               = {rate for rate in CANDIDATES if maxBaud is None or rate <= maxBaud}
+        self.candidates     = sorted(rates | {self.baseRate}, reverse=True)
+        self.failed         = set()
+
+        self.proposed       = None      # rate offered to the device, awaiting ok/no
+        self.pending        = None      # rate switched to, awaiting sync
+        self.previous       = None
+        self.deadline       = None      # set while waiting for the device's sync
+
+        self.windowBytes    = 0
+        self.windowErrors   = 0
+        self.switches       = 0
+        self.fallbacks      = 0
+
+    @property
+    def verifying(self):
+        return self.deadline is not None
+
+    def propose(self, below=None):
+        """ Offers the fastest rate still worth trying, under below if given """
+        current = self.ser.baudrate
+        for rate in self.candidates:
+            if rate in self.failed or rate == current or (below is not None and rate >= below):
+                continue
+            if below is None and rate < current:
+                return
+            self.proposed = rate
+            self.ser.write(b'baud %d\n' % rate)
+            return
+
+    def on_pause(self):
+        self.propose()
+
+    def on_reply(self, word, line):
+        """ Handles an 'ok <rate>' or 'no <rate>' line from the device """
+        try:
+            rate = int(line.split()[1])
+        except (IndexError, ValueError):
+            return
+        if rate != self.proposed:
+            return
+        self.proposed = None
+        if word == b'no ':
+            self.failed.add(rate)
+            self.propose(below=rate)
+            return
+
+        self.previous = self.ser.baudrate
+        try:
+            self.ser.baudrate = rate
+        except (ValueError, serial.SerialException):
+            # the adapter can't do it, the device will give up waiting for our sync
+            self.log(f"Serial adapter does not support {rate} baud")
+        self.pending = rate
+        self.deadline = time.monotonic() + SYNC_TIMEOUT
+
+    def on_sync(self):
+        self.ser.write(b'sync\n')
+        self.deadline = None
+        self.switches += 1
+        self.reset_window()
+        self.log(f"Link running at {self.ser.baudrate} baud")
+
+    def check_timeout(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.failed.add(self.pending)
+            self.ser.baudrate = self.previous
+            self.deadline = None
+            self.fallbacks += 1
+            self.log(f"No sync at {self.pending} baud, back to {self.previous}")
+
+    def reset_window(self):
+        self.windowBytes = 0
+        self.windowErrors = 0
+
+    def count_errors(self, data):
+        """ Tracks garbled bytes in newly received text """
+        self.add_errors(len(data), len(data.translate(None, VALID_BYTES)))
+
+    def add_errors(self, received, errors):
+        """ Adds errors in received bytes to the window, falling back when there are too many """
+        self.windowBytes += received
+        self.windowErrors += errors
+        if self.windowBytes < ERROR_WINDOW:
+            return
+        errorRate = self.windowErrors / self.windowBytes
+        self.reset_window()
+        current = self.ser.baudrate
+        if errorRate > ERROR_RATE and current > self.baseRate and self.proposed is None:
+            self.failed.add(current)
+            self.fallbacks += 1
+            self.log(f"Garbled byte rate {errorRate:.2e} at {current} baud, falling back")
+            self.propose(below=current)
+
+    def close(self):
+        if self.ser.baudrate != self.baseRate:
+            self.ser.baudrate = self.baseRate
+        if self.switches or self.fallbacks:
+            self.log(f"Baud negotiation: {self.switches} switches, {self.fallbacks} fallbacks")
@@ -0,0 +1,206 @@
+import argparse
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import emulator
+import receiver
+
+
+DRIVER_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ['cli', 'gui', 'transfer']
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=DRIVER_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def command(mode, port, dataset, destination, recordsPerFile, negotiate, binary):
+    if mode == 'cli':
+        options = (['--negotiate-baud'] if negotiate else []) + (['--binary'] if binary else [])
+        return [sys.executable, 'main.py', 'cli', '--port', port, '-l', destination, '-r', str(recordsPerFile)] + options
+    elif mode == 'gui':
+        return [sys.executable, 'bench.py', '--gui-worker', port, destination, str(recordsPerFile)]
+    return [sys.executable, 'main.py', 'transfer', '--port', port, '-f', dataset]
+
+
+def received_records(destination):
+    lines = 0
+    for path in glob.glob(destination + "/*.fn"):
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(1 << 20)
+                if not block:
+                    break
+                lines += block.count(b'\n')
+    return lines // 3
+
+
+def run_case(mode, dataset, recordsPerFile, timeout, negotiate=False, binary=False):
+    """ Runs one driver process against a fresh emulator
+
+        :returns:
+            A dict of results for the case
+    """
+    with tempfile.TemporaryDirectory() as destination, emulator.Emulator(dataset, negotiate=negotiate) as device:
+        proc = subprocess.Popen(command(mode, device.port, dataset, destination, recordsPerFile, negotiate, binary), cwd=DRIVER_DIR,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        stats = device.session(timeout=timeout)
+
+        if mode == 'cli':
+            # the CLI never exits on its own, stop it once it reports the transfer finished
+            for line in proc.stderr:
+                if receiver.STATUS_DONE in line:
+                    break
+            end = time.monotonic()
+            proc.terminate()
+        elif mode == 'gui':
+            proc.stderr.read()
+            end = None
+        else:
+            end = stats['end']
+
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        exitCode = proc.returncode
+        if mode == 'cli' and exitCode in (-signal.SIGTERM, 128 + signal.SIGTERM):
+            exitCode = 0        # stopped by us above
+        end = end or time.monotonic()
+
+        records = stats['records'] if mode == 'transfer' else received_records(destination)
+
+    seconds = end - stats['start']
+    return {
+        'time':             datetime.now().isoformat(timespec='seconds'),
+        'version':          version(),
+        'mode':             mode + ('+negotiate' if negotiate else '') + ('+binary' if binary else ''),
+        'records':          records,
+        'expected':         stats['records'],
+        'bytes':            stats['bytes'],
+        'seconds':          round(seconds, 4),
+        'records_per_s':    round(records / seconds, 1),
+        'mb_per_s':         round(stats['bytes'] / seconds / 1e6, 3),
+        'cpu_s':            round(usage.ru_utime + usage.ru_stime, 4),
+        'peak_rss_kb':      usage.ru_maxrss,
+        'max_in_waiting':   stats['max_in_waiting'],
+        'exit_code':        exitCode,
+    }
+
+
+def previous_result(path, result):
+    """ Finds the last saved result for the same mode and dataset size """
+    if not os.path.isfile(path):
+        return None
+    last = None
+    with open(path, "r") as f:
+        for line in f:
+            saved = json.loads(line)
+            if saved['mode'] == result['mode'] and saved['expected'] == result['expected']:
+                last = saved
+    return last
+
+
+def report(result, previous):
+    line = (f"{result['mode']:<9} {result['records_per_s']:>11.0f} rec/s {result['mb_per_s']:>8.2f} MB/s "
+            f"cpu {result['cpu_s']:>7.3f}s  rss {result['peak_rss_kb'] / 1024:>6.1f}MB  "
+            f"max in_waiting {result['max_in_waiting']}")
+    if previous:
+        change = (result['records_per_s'] / previous['records_per_s'] - 1) * 100
+        line += f"  ({change:+.1f}% vs {previous['version']})"
+    if result.get('exit_code'):
+        line += f"  FAILED: driver exited with {result['exit_code']}"
+    if result['records'] != result['expected']:
+        line += f"  MISMATCH: received {result['records']} of {result['expected']} records"
+    print(line, flush=True)
+
+
+def gui_worker(port, destination, recordsPerFile):
+    import gui
+    backend = gui.Backend()
+    backend.destination_folder = destination
+    backend.update_records(recordsPerFile)
+    backend.quickReadSerial(port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mGRUE-bench', description='Benchmark the mGRUE driver against the emulator')
+    parser.add_argument('modes',
+                        nargs='*',
+                        metavar='mode',
+                        help='driver paths to benchmark: cli, gui and/or transfer. Default all.')
+    parser.add_argument('-n',
+                        '--records',
+                        type=int,
+                        default=200000,
+                        help='number of records in the generated dataset. Default 200000.')
+    parser.add_argument('--length',
+                        type=int,
+                        default=150,
+                        help='mean sequence length of the generated dataset. Default 150.')
+    parser.add_argument('-f',
+                        '--file',
+                        help='benchmark with this dataset instead of a generated one')
+    parser.add_argument('-r',
+                        '--records-per-file',
+                        type=int,
+                        default=4000,
+                        help='the number of records per output file. Default 4000.')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='number of runs of each mode. Default 1.')
+    parser.add_argument('--negotiate',
+                        action='store_true',
+                        help='have the emulator and the cli negotiate a baud rate')
+    parser.add_argument('--binary',
+                        action='store_true',
+                        help='have the emulator and the cli use binary framing')
+    parser.add_argument('--results',
+                        default='bench_results.jsonl',
+                        help='file the results are appended to. Default bench_results.jsonl.')
+    parser.add_argument('--gui-worker',
+                        nargs=3,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.gui_worker:
+        port, destination, recordsPerFile = args.gui_worker
+        gui_worker(port, destination, int(recordsPerFile))
+        sys.exit(0)
+
+    modes = args.modes or MODES
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"invalid mode {mode!r} (choose from {', '.join(MODES)})")
+    if 'gui' in modes:
+        try:
+            import PySide2      # noqa: F401
+        except ImportError:
+            print("PySide2 is not installed, skipping the gui benchmark")
+            modes = [mode for mode in modes if mode != 'gui']
+
+    dataset = args.file
+    if dataset is None:
+        dataset = os.path.join(tempfile.gettempdir(), f"mgrue-bench-{args.records}x{args.length}.fn")
+        if not os.path.isfile(dataset):
+            print(f"Generating {args.records} records -> {dataset}")
+            emulator.generate_dataset(dataset, args.records, args.length)
+
+    results = os.path.abspath(args.results)
+    for mode in modes:
+        for _ in range(args.repeat):
+            result = run_case(mode, os.path.abspath(dataset), args.records_per_file, timeout=30,
+                              negotiate=args.negotiate, binary=args.binary)
+            report(result, previous_result(results, result))
+            with open(results, "a") as f:
+                f.write(json.dumps(result) + "\n")
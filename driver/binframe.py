@@ -0,0 +1,156 @@
+import re
+import struct
+import zlib
+
+
+# Frame layout, integers little endian:
+#
+#   magic   u8      0xA5
+#   kind    u8      RECORD or CONTROL
+#   length  u32     payload length
+#   check   u8      low byte of the CRC-32 of kind and length
+#   payload
+#   crc     u32     CRC-32 of everything after the magic byte
+#
+# The header check lets a decoder reject a corrupt length straight away
+# instead of waiting for up to MAX_PAYLOAD bytes before the CRC fails.
+#
+# A CONTROL payload is a command the text protocol would send as a line
+# (done, pause, kill, ok <rate>, ...). A RECORD payload is
+#
+#   u16     header length, then the '>' header line without its newline
+#   u32     number of bases
+#   u32     number of escapes, then per escape u32 position and u8 symbol
+#   packed bases, four to a byte, first base in the top two bits
+#
+# Bases other than A/C/G/T (N, lower case, IUPAC codes) are packed as A and
+# listed as escapes, so any sequence line round trips unchanged.
+
+MAGIC           = 0xA5
+RECORD          = ord('R')
+CONTROL         = ord('C')
+HEADER          = struct.Struct('<BBIB')
+CRC             = struct.Struct('<I')
+MAX_PAYLOAD     = 1 << 20       # anything longer is a corrupt length, not a real frame
+
+BASES           = b'ACGT'
+PACK_CODES      = bytes.maketrans(BASES, bytes(range(4)))
+UNPACK          = [bytes(BASES[(i >> shift) & 3] for i in range(256)) for shift in (6, 4, 2, 0)]
+NOT_BASE        = re.compile(rb'[^ACGT]')
+
+
+def header_check(kind, length):
+    return zlib.crc32(struct.pack('<BI', kind, length)) & 0xff
+
+
+def frame(kind, payload):
+    body = HEADER.pack(MAGIC, kind, len(payload), header_check(kind, len(payload)))[1:] + payload
+    return bytes([MAGIC]) + body + CRC.pack(zlib.crc32(body))
+
+
+def encode_control(word):
+    return frame(CONTROL, word)
+
+
+def encode_record(header, sequence):
+    """ Frames one record, header being the '>' line and sequence the bases, both without newlines """
+    escapes = [(m.start(), m.group()[0]) for m in NOT_BASE.finditer(sequence)]
+    codes = sequence.translate(PACK_CODES)
+    if escapes:
+        codes = bytearray(codes)
+        for pos, _ in escapes:
+            codes[pos] = 0
+    codes = bytes(codes) + bytes(-len(codes) % 4)
+    packed = bytes((codes[i] << 6) | (codes[i + 1] << 4) | (codes[i + 2] << 2) | codes[i + 3]
+                   for i in range(0, len(codes), 4))
+
+    payload = bytearray(struct.pack('<H', len(header)))
+    payload += header
+    payload += struct.pack('<II', len(sequence), len(escapes))
+    for pos, symbol in escapes:
+        payload += struct.pack('<IB', pos, symbol)
+    payload += packed
+    return frame(RECORD, bytes(payload))
+
+
+def decode_record(payload, out):
+    """ Appends the '\\n' terminated 3-line text form of a RECORD payload to out """
+    headerLength, = struct.unpack_from('<H', payload, 0)
+    pos = 2 + headerLength
+    length, escapes = struct.unpack_from('<II', payload, pos)
+    pos += 8
+    escapeAt = pos
+    pos += 5 * escapes
+
+    packed = bytes(payload[pos:pos + (length + 3) // 4])
+    sequence = bytearray(4 * len(packed))
+    for i, table in enumerate(UNPACK):
+        sequence[i::4] = packed.translate(table)
+    del sequence[length:]
+    for _ in range(escapes):
+        at, symbol = struct.unpack_from('<IB', payload, escapeAt)
+        sequence[at] = symbol
+        escapeAt += 5
+
+    out += payload[2:2 + headerLength]
+    out += b'\n'
+    out += sequence
+    out += b'\n\n'
+
+
+class FrameDecoder:
+    """ Turns a stream of frames back into .fn text and control words
+
+        Frames that fail their CRC are dropped and the decoder resynchronises
+        on the next magic byte. crcErrors counts dropped frames and skipped
+        the bytes thrown away looking for a frame start.
+    """
+
+    def __init__(self):
+        self.crcErrors  = 0
+        self.skipped    = 0
+
+    def decode(self, buffer, view, end):
+        """ Decodes every complete frame in buffer[:end]
+
+            :returns:
+                (bytes consumed, events) where events is a list of
+                ('text', bytearray) and ('control', bytes) in stream order
+        """
+        events = []
+        text = bytearray()
+        pos = 0
+        while end - pos >= HEADER.size:
+            if buffer[pos] != MAGIC:
+                nxt = buffer.find(MAGIC, pos + 1, end)
+                nxt = end if nxt < 0 else nxt
+                self.skipped += nxt - pos
+                pos = nxt
+                continue
+            _, kind, length, check = HEADER.unpack_from(buffer, pos)
+            if length > MAX_PAYLOAD or kind not in (RECORD, CONTROL) or header_check(kind, length) != check:
+                self.skipped += 1
+                pos += 1
+                continue
+            frameEnd = pos + HEADER.size + length + CRC.size
+            if frameEnd > end:
+                break
+            crc, = CRC.unpack_from(buffer, frameEnd - CRC.size)
+            if zlib.crc32(view[pos + 1:frameEnd - CRC.size]) != crc:
+                self.crcErrors += 1
+                self.skipped += 1
+                pos += 1
+                continue
+
+            payload = view[pos + HEADER.size:frameEnd - CRC.size]
+            if kind == RECORD:
+                decode_record(payload, text)
+            else:
+                if text:
+                    events.append(('text', text))
+                    text = bytearray()
+                events.append(('control', bytes(payload)))
+            pos = frameEnd
+        if text:
+            events.append(('text', text))
+        return pos, events
@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+
+
+FILE_NAME   = "checkpoint.json"
+INTERVAL    = 1             # seconds between checkpoints while data is flowing
+
+
+class Checkpoint:
+    """ How far an unfinished transfer got, saved next to its output
+
+        records counts every complete record on disk, fileRecords and
+        offset say where the last of them ends in file fileCounter of the
+        <curTime>_file<N>.fn set. Anything after offset is a torn record and
+        is cut off when the transfer resumes.
+    """
+
+    def __init__(self, curTime, fileCounter=0, fileRecords=0, offset=0, records=0):
+        self.curTime        = curTime
+        self.fileCounter    = fileCounter
+        self.fileRecords    = fileRecords
+        self.offset         = offset
+        self.records        = records
+
+    def file_name(self, destination):
+        return destination + "/" + self.curTime + "_file" + str(self.fileCounter) + ".fn"
+
+    def save(self, destination):
+        """ Replaces the saved checkpoint, so a crash leaves either the old one or the new one """
+        path = os.path.join(destination, FILE_NAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(vars(self), f)
+        os.replace(path + ".tmp", path)
+
+
+def load(destination):
+    """ Reads the checkpoint saved in destination
+
+        :returns:
+            The Checkpoint, or None if there is none or its output file is
+            missing or shorter than the checkpoint says
+    """
+    path = os.path.join(destination, FILE_NAME)
+    try:
+        with open(path) as f:
+            saved = Checkpoint(**json.load(f))
+        size = os.path.getsize(saved.file_name(destination))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError) as e:
+        logging.warning(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+    if size < saved.offset:
+        logging.warning(f"Ignoring checkpoint {path}: {saved.file_name(destination)} is shorter than recorded")
+        return None
+    return saved
+
+
+def remove(destination):
+    try:
+        os.remove(os.path.join(destination, FILE_NAME))
+    except FileNotFoundError:
+        pass
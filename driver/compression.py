@@ -0,0 +1,120 @@
+import gzip
+import logging
+import lzma
+import os
+import struct
+import zlib
+
+import qc
+import workers
+
+
+FORMATS     = ['none', 'gzip', 'bgzip', 'lzma']
+SUFFIXES    = {'gzip': ".gz", 'bgzip': ".gz", 'lzma': ".xz"}
+READ_SIZE   = 1 << 20
+
+# BGZF, the blocked gzip of bgzip/htslib: a series of gzip members of at most
+# 64 KiB each, with the member's size in a 'BC' extra field, and an empty
+# member at the end.
+BGZF_BLOCK  = 0xff00
+BGZF_HEADER = struct.Struct('<BBBBIBBHBBHH')
+BGZF_EOF    = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def bgzf_block(data, level):
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = deflate.compress(data) + deflate.flush()
+    size = BGZF_HEADER.size + len(body) + 8
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, ord('B'), ord('C'), 2, size - 1)
+    return header + body + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def compress_file(path, fmt, level=6, stats=False):
+    """ Replaces path with a compressed copy named path + SUFFIXES[fmt]
+
+        The copy is written under a temporary name and only takes the
+        original's place once it is complete, so an interrupted compression
+        never loses data. With stats set the file's qc.file_stats() are
+        worked out first, while it is still there.
+
+        :returns:
+            (bytes before, bytes after, stats or None)
+    """
+    figures = qc.file_stats(path) if stats else None
+    target = path + SUFFIXES[fmt]
+    with open(path, "rb") as src, open(target + ".tmp", "wb") as raw:
+        if fmt == 'gzip':
+            out = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=level, mtime=0)
+        elif fmt == 'lzma':
+            out = lzma.LZMAFile(raw, "wb", preset=level)
+        else:
+            out = raw
+        with out:
+            while True:
+                data = src.read(BGZF_BLOCK if fmt == 'bgzip' else READ_SIZE)
+                if not data:
+                    break
+                out.write(bgzf_block(data, level) if fmt == 'bgzip' else data)
+            if fmt == 'bgzip':
+                out.write(BGZF_EOF)
+    os.replace(target + ".tmp", target)
+    before, after = os.path.getsize(path), os.path.getsize(target)
+    os.remove(path)
+    return before, after, figures
+
+
+def open_compressed(path):
+    """ Opens the .fn file at path for reading whether or not it has been compressed since """
+    if os.path.exists(path):
+        return open(path, "rb")
+    if os.path.exists(path + ".gz"):
+        return gzip.open(path + ".gz", "rb")      # reads bgzip too
+    if os.path.exists(path + ".xz"):
+        return lzma.open(path + ".xz", "rb")
+    raise FileNotFoundError(path)
+
+
+class Compressor:
+    """ Compresses finished output files in a process pool
+
+        Files are handed over once they are closed, so compression runs
+        alongside the transfer on other cores and the reader and writer
+        threads never wait for it. wait() collects the results at the end.
+    """
+
+    def __init__(self, fmt, level=6):
+        self.fmt        = fmt
+        self.level      = level
+        self.pending    = []
+        self.before     = 0
+        self.after      = 0
+        self.files      = 0
+        self.failed     = 0
+
+    def submit(self, path, stats=False):
+        """ Queues path for compression, and QC first with stats set
+
+            :returns:
+                The future of the compress_file() call
+        """
+        future = workers.get_pool().submit(compress_file, path, self.fmt, self.level, stats)
+        self.pending.append(future)
+        return future
+
+    def wait(self):
+        for future in self.pending:
+            try:
+                before, after, _ = future.result()
+            except Exception as e:      # the file is still there uncompressed, see compress_file()
+                logging.error(f"Compression ({self.fmt}): {e!r}")
+                self.failed += 1
+                continue
+            self.before += before
+            self.after += after
+            self.files += 1
+        self.pending.clear()
+        if self.failed:
+            logging.warning(f"Compression ({self.fmt}): {self.failed} files left uncompressed")
+        if self.files:
+            logging.info(f"Compression ({self.fmt}): {self.files} files, {self.before} -> {self.after} bytes "
+                         f"({self.after / max(self.before, 1):.1%})")
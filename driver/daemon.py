@@ -0,0 +1,169 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), "mgrue-driver.sock")
+COMMANDS    = ['status', 'destination', 'records', 'rotate', 'stop']
+
+
+class Daemon:
+    """ Keeps capturing until told to stop, controlled over a Unix domain socket
+
+        The devices stay open and every 'connect' starts a transfer, as with
+        devices.DeviceManager. A client sends one command per line and gets
+        one JSON object per line back, with "ok" and either the result or
+        "error":
+
+            status                  each device's status, records and current file
+            destination <path>      where the next transfers are written
+            records <n>             records per file, also for transfers in progress
+            rotate                  start new files at the next record boundary
+            stop                    end once the transfers in progress are done
+    """
+
+    def __init__(self, manager, socketPath=SOCKET_PATH):
+        self.manager    = manager
+        self.socketPath = socketPath
+        self.server     = None
+
+    def status(self):
+        sessions = {}
+        for session in list(self.manager.sessions.values()):
+            current = session.receiver
+            sessions[session.deviceName] = {
+                'port':         session.port,
+                'connected':    session.is_alive(),
+                'status':       session.currentStatus,
+                'records':      session.total_records(),
+                'transfers':    session.transfers,
+                'file':         current.writer.file_name() if current else None,
+            }
+        return {'destination': self.manager.destination, 'records_per_file': self.manager.recordsPerFile,
+                'devices': sessions}
+
+    def receivers(self):
+        return [r for r in (s.receiver for s in list(self.manager.sessions.values())) if r]
+
+    def handle(self, line):
+        """ Runs one command line
+
+            :returns:
+                The reply as a dict
+        """
+        words = line.split(maxsplit=1)
+        command = words[0] if words else ''
+        argument = words[1] if len(words) > 1 else None
+        if command == 'status':
+            return dict(ok=True, **self.status())
+        elif command == 'destination':
+            if not argument or not os.path.isdir(argument):
+                return {'ok': False, 'error': f"{argument} is not a valid directory"}
+            self.manager.destination = argument
+            return {'ok': True, 'destination': argument}
+        elif command == 'records':
+            try:
+                n = int(argument)
+            except (TypeError, ValueError):
+                n = 0
+            if n <= 0:
+                return {'ok': False, 'error': "records per file must be a positive number"}
+            self.manager.recordsPerFile = n
+            for current in self.receivers():
+                current.recordsPerFile = n
+            return {'ok': True, 'records_per_file': n}
+        elif command == 'rotate':
+            receivers = self.receivers()
+            for current in receivers:
+                current.request_rotate()
+            return {'ok': True, 'rotating': len(receivers)}
+        elif command == 'stop':
+            self.manager.stop()
+            return {'ok': True, 'stopping': len(self.receivers())}
+        return {'ok': False, 'error': f"unknown command {command!r}, expected one of {', '.join(COMMANDS)}"}
+
+    def serve(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError("daemon mode needs Unix domain sockets")
+        if os.path.exists(self.socketPath):
+            if ping(self.socketPath):
+                raise OSError(f"a driver is already listening on {self.socketPath}")
+            os.remove(self.socketPath)      # left behind by a daemon that didn't shut down
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    reply = daemon.handle(line.decode("utf-8", errors='replace').strip())
+                    self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.socketPath, Handler)
+        self.server.daemon_threads = True
+        os.chmod(self.socketPath, 0o600)
+        threading.Thread(target=self.server.serve_forever, name="mgrue-control", daemon=True).start()
+        logging.info(f"Listening for commands on {self.socketPath}")
+
+    def run(self):
+        """ Captures until a stop command, then waits for transfers in progress to finish """
+        self.serve()
+        try:
+            self.manager.run()
+            self.manager.join()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.socketPath)
+
+
+def send_command(command, socketPath=SOCKET_PATH, timeout=5):
+    """ Sends one command to a running daemon
+
+        :returns:
+            The daemon's reply as a dict
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socketPath)
+        sock.sendall(command.encode() + b'\n')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = sock.recv(65536)
+            if not data:
+                break
+            reply += data
+    return json.loads(reply)
+
+
+def ping(socketPath):
+    try:
+        send_command('status', socketPath, timeout=1)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mGRUE-ctl', description='Send a command to a running mGRUE driver daemon')
+    parser.add_argument('command',
+                        nargs='+',
+                        help=f"one of {', '.join(COMMANDS)}, with its argument")
+    parser.add_argument('-s',
+                        '--socket',
+                        default=SOCKET_PATH,
+                        help=f'control socket of the daemon. Default {SOCKET_PATH}.')
+    args = parser.parse_args()
+
+    try:
+        reply = send_command(" ".join(args.command), args.socket)
+    except OSError as e:
+        print(f"ERROR: could not reach the daemon on {args.socket}: {e}")
+        sys.exit(1)
+    print(json.dumps(reply, indent=2))
+    sys.exit(0 if reply.get('ok') else 1)
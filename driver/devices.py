@@ -0,0 +1,159 @@
+import logging
+import os
+import threading
+import time
+
+import serial
+
+import discovery
+import receiver
+
+
+STATUS_WAITING      = "Awaiting command from device..."
+STATUS_NO_FOLDER    = "Error, must set folder before sending data."
+
+RESCAN_INTERVAL     = 1         # seconds between checks for new or lost devices
+RETRY_INTERVAL      = 5         # seconds before a port that failed is opened again
+SUMMARY_INTERVAL    = 10        # seconds between aggregate status lines while data is flowing
+
+
+class DeviceSession(threading.Thread):
+    """ Captures from one device on a thread of its own
+
+        Every transfer from the device goes to <destination>/<name>, so each
+        device has its own files, rotation and status. The port stays open
+        between transfers. The thread ends when the port goes away;
+        DeviceManager starts a new one if it comes back.
+    """
+
+    def __init__(self, manager, port, name):
+        super().__init__(name="mgrue-" + name, daemon=True)
+        self.manager        = manager
+        self.port           = port
+        self.deviceName     = name
+        self.currentStatus  = STATUS_WAITING
+        self.receiver       = None      # the Receiver of the transfer in progress
+        self.transfers      = 0
+        self.records        = 0         # records in finished transfers
+        self.endedAt        = None
+
+    def update_status(self, msg):
+        self.currentStatus = msg
+        self.manager.device_status(self, msg)
+
+    def total_records(self):
+        current = self.receiver
+        return self.records + (current.records if current else 0)
+
+    def in_progress(self):
+        return self.receiver is not None
+
+    def run(self):
+        try:
+            with serial.Serial(self.port, 921600, timeout=1) as ser:
+                self.update_status(STATUS_WAITING)
+                while not self.manager.stopped.is_set():
+                    if receiver.read_command(ser) != 'connect':
+                        continue
+                    if not self.manager.destination:
+                        self.update_status(STATUS_NO_FOLDER)
+                        continue
+                    destination = self.manager.destination
+                    if not self.manager.single:
+                        destination = os.path.join(destination, self.deviceName)
+                        os.makedirs(destination, exist_ok=True)
+                    self.receiver = receiver.Receiver(ser, destination, self.manager.recordsPerFile,
+                                                      status=self.update_status, name=self.deviceName,
+                                                      **self.manager.options)
+                    try:
+                        self.receiver.run()
+                    finally:
+                        self.records += self.receiver.records
+                        self.transfers += 1
+                        self.receiver = None
+        except serial.SerialException as e:      # unplugged, or the port could not be opened
+            self.update_status(f"Disconnected ({e})")
+        finally:
+            self.endedAt = time.monotonic()
+
+
+class DeviceManager:
+    """ Captures from every connected mGRUE device at once
+
+        A DeviceSession is started for each port that discovery finds, or
+        for each of ports if given, and restarted when a device comes back
+        after being unplugged. Per device status changes are reported as
+        '<name>: <status>' through the status callback, along with a summary
+        of all devices every SUMMARY_INTERVAL seconds while any is receiving.
+
+        options are passed on to every receiver.Receiver. With single set
+        only the best matching device is used, and it writes straight into
+        destination. destination and recordsPerFile may be changed at any
+        time and apply from the next transfer.
+    """
+
+    def __init__(self, destination, recordsPerFile, options=None, deviceFilter=None, ports=None,
+                 status=logging.info, single=False):
+        self.destination    = destination
+        self.recordsPerFile = recordsPerFile
+        self.options        = options or {}
+        self.ports          = ports     # fixed ports, discovery is used when None
+        self.status         = status
+        self.single         = single
+        self.discovery      = discovery.Discovery(deviceFilter)
+        self.sessions       = {}        # port -> DeviceSession
+        self.stopped        = threading.Event()
+        self.lock           = threading.Lock()
+
+    def device_status(self, session, msg):
+        with self.lock:
+            self.status(f"{session.deviceName}: {msg}")
+
+    def find_ports(self):
+        ports = self.ports if self.ports else self.discovery.find_devices()
+        return ports[:1] if self.single else ports
+
+    def start_sessions(self):
+        if self.single and any(session.is_alive() for session in self.sessions.values()):
+            return
+        now = time.monotonic()
+        for port in self.find_ports():
+            session = self.sessions.get(port)
+            if session is not None and (session.is_alive() or now - session.endedAt < RETRY_INTERVAL):
+                continue
+            session = DeviceSession(self, port, self.discovery.device_name(port))
+            self.sessions[port] = session
+            session.start()
+
+    def summary(self):
+        """ One line describing every device, e.g. '2 devices | ttyUSB0: Paused. 4000 records | ...' """
+        sessions = list(self.sessions.values())
+        parts = [f"{len(sessions)} device{'' if len(sessions) == 1 else 's'}"]
+        for session in sessions:
+            state = session.currentStatus if session.is_alive() else "Disconnected"
+            parts.append(f"{session.deviceName}: {state} {session.total_records()} records")
+        return " | ".join(parts)
+
+    def run(self):
+        """ Keeps a session running for every device until stop() is called """
+        nextSummary = time.monotonic() + SUMMARY_INTERVAL
+        while not self.stopped.is_set():
+            self.start_sessions()
+            if time.monotonic() >= nextSummary:
+                nextSummary = time.monotonic() + SUMMARY_INTERVAL
+                if any(session.in_progress() for session in self.sessions.values()):
+                    with self.lock:
+                        self.status(self.summary())
+            if self.ports:
+                self.stopped.wait(RESCAN_INTERVAL)
+            else:
+                self.discovery.wait_for_change(RESCAN_INTERVAL)
+
+    def stop(self):
+        """ Stops looking for devices, sessions finish the transfer they are in first """
+        self.stopped.set()
+
+    def join(self):
+        """ Waits for every session to end after stop() """
+        for session in list(self.sessions.values()):
+            session.join()
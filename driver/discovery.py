@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+
+from serial.tools import list_ports
+
+try:
+    import pyudev           # optional, lets Linux wait on udev hotplug events instead of polling
+except ImportError:
+    pyudev = None
+
+
+POLL_INTERVAL   = .5        # seconds between scans when no hotplug monitor is available
+CACHE_TTL       = 2         # seconds a scan is trusted for when no hotplug monitor is available
+NAME_HINT       = "mgrue"   # ports whose description mentions this are preferred
+
+
+class DeviceFilter:
+    """ Describes which USB serial devices count as an mGRUE
+
+        Any field left as None matches everything. Ports are identified by
+        their USB metadata, so nothing is opened while scanning.
+    """
+
+    def __init__(self, vid=None, pid=None, serialNumber=None):
+        self.vid            = vid
+        self.pid            = pid
+        self.serialNumber   = serialNumber
+
+    def key(self):
+        return (self.vid, self.pid, self.serialNumber)
+
+    def matches(self, info):
+        if info.vid is None:        # not a USB device, e.g. a motherboard /dev/ttyS* port
+            return False
+        if self.vid is not None and info.vid != self.vid:
+            return False
+        if self.pid is not None and info.pid != self.pid:
+            return False
+        if self.serialNumber is not None and info.serial_number != self.serialNumber:
+            return False
+        return True
+
+
+def describes_mgrue(info):
+    text = " ".join(filter(None, (info.description, info.manufacturer, info.product)))
+    return NAME_HINT in text.lower()
+
+
+class Discovery:
+    """ Finds mGRUE devices and caches the result until the ports change
+
+        On Linux with pyudev installed, the cache is invalidated by tty
+        hotplug events and wait_for_device() sleeps on the udev socket.
+        Elsewhere the port list is rescanned at most every CACHE_TTL seconds
+        while waiting.
+    """
+
+    def __init__(self, deviceFilter=None):
+        self.deviceFilter   = deviceFilter or DeviceFilter()
+        self.monitor        = None
+        self.cache          = None
+        self.scannedAt      = 0
+        self.serialNumbers  = {}        # port -> USB serial number, from the last scan
+
+        if pyudev is not None and sys.platform.startswith('linux'):
+            self.monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            self.monitor.filter_by('tty')
+            self.monitor.start()
+
+    def scan(self):
+        infos = [info for info in list_ports.comports() if self.deviceFilter.matches(info)]
+        # devices that name themselves mGRUE first, then by port name for a stable choice
+        infos.sort(key=lambda info: (not describes_mgrue(info), info.device))
+        self.serialNumbers.update((info.device, info.serial_number) for info in infos)
+        return [info.device for info in infos]
+
+    def stale(self):
+        if self.cache is None:
+            return True
+        if self.monitor is not None:
+            return self.monitor.poll(timeout=0) is not None
+        return time.monotonic() - self.scannedAt > CACHE_TTL
+
+    def find_devices(self, refresh=False):
+        """ Lists the ports of every connected device that matches the filter
+
+            :returns:
+                A list of port names, best match first
+        """
+        if refresh or self.stale():
+            self.cache = self.scan()
+            self.scannedAt = time.monotonic()
+        return self.cache
+
+    def device_name(self, port):
+        """ A name for the device on port that stays the same across replugs where possible """
+        return self.serialNumbers.get(port) or os.path.basename(port)
+
+    def invalidate(self):
+        self.cache = None
+
+    def wait_for_change(self, timeout):
+        if self.monitor is not None:
+            if self.monitor.poll(timeout=timeout) is not None:
+                self.invalidate()
+        else:
+            time.sleep(min(timeout, POLL_INTERVAL))
+            self.invalidate()
+
+    def wait_for_device(self, timeout=None):
+        """ Waits for a matching device to be plugged in
+
+            :returns:
+                The best matching port, or None if timeout seconds passed first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ports = self.find_devices()
+            if ports:
+                return ports[0]
+            remaining = POLL_INTERVAL if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.wait_for_change(remaining)
+
+
+def parse_id(value):
+    """ argparse type for a USB vendor/product id given in hex, e.g. 2e8a or 0x2e8a """
+    return int(value, 16)
@@ -0,0 +1,407 @@
+import argparse
+import fcntl
+import os
+import pty
+import random
+import select
+import struct
+import sys
+import termios
+import time
+import tty
+
+import baudrate
+import binframe
+
+
+CHUNK_SIZE  = 4096
+BASE_RATE   = baudrate.BASE_RATE
+
+XON         = 0x11
+XOFF        = 0x13
+
+
+def generate_dataset(path, records, length=150, seed=0):
+    """ Writes a synthetic .fn dataset of 3-line >header/sequence/blank records
+
+        :returns:
+            The number of bytes written
+    """
+    rng = random.Random(seed)
+    size = 0
+    with open(path, "wb") as f:
+        for i in range(records):
+            n = max(1, int(rng.gauss(length, length / 4)))
+            sequence = "".join(rng.choices("ACGT", k=n))
+            if rng.random() < 0.05:
+                sequence = sequence[:n // 2] + "N" + sequence[n // 2 + 1:]
+            record = f">read_{i} ch={rng.randint(1, 512)} len={n}\n{sequence}\n\n".encode()
+            f.write(record)
+            size += len(record)
+    return size
+
+
+class Emulator:
+    """ Stands in for an mGRUE device on one end of a pseudo-terminal pair
+
+        The driver opens Emulator.port like any other serial port. Each
+        session starts with the device sending 'connect' until the host
+        answers: 'handshake' makes the device stream a .fn dataset followed by
+        'done', 'transfer' makes it read the host's upload until 'done'.
+        'handshake binary' streams the same dataset as binframe frames, and
+        either handshake followed by 'resume <N>' skips the first N records.
+
+        While streaming, XOFF from the host holds the output until XON. With
+        negotiate set, streaming starts with a pause offering a baud rate
+        change, answered as described in baudrate.Negotiator.
+        The slave end is kept open here as well, so the number of bytes
+        waiting for the driver (its in_waiting) can be sampled with FIONREAD.
+    """
+
+    def __init__(self, dataset=None, baud=None, pauseEvery=0, killAfter=0, chunkSize=CHUNK_SIZE,
+                 negotiate=False, maxBaud=None, stableBaud=None):
+        self.dataset    = dataset
+        self.baud       = baud              # pace output to this baud rate, None to send as fast as possible
+        self.pauseEvery = pauseEvery        # send 'pause' every pauseEvery records
+        self.killAfter  = killAfter         # send 'kill' instead of 'done' after killAfter records
+        self.chunkSize  = chunkSize
+        self.negotiate  = negotiate         # offer a baud rate change when streaming starts
+        self.maxBaud    = maxBaud           # answer 'no' to faster proposals
+        self.stableBaud = stableBaud        # garble data sent faster than this
+        self.rate       = BASE_RATE
+        self.command    = b''               # unfinished command line from the host
+        self.proposals  = []                # baud rates the host asked for mid-stream
+        self.binary     = False             # the host asked for binframe frames this session
+        self.encoded    = None              # the dataset as blocks of frames, built on first use
+        self.lineStart  = True
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def in_waiting(self, fd=None):
+        buf = fcntl.ioctl(self.slave if fd is None else fd, termios.FIONREAD, struct.pack('I', 0))
+        return struct.unpack('I', buf)[0]
+
+    def read_line(self, timeout=None):
+        line = b''
+        while not line.endswith(b'\n'):
+            ready, _, _ = select.select([self.master], [], [], timeout)
+            if not ready:
+                return None
+            line += os.read(self.master, 1)
+        return line[:-1]
+
+    def connect(self, timeout=None):
+        """ Sends 'connect' until the host answers
+
+            :returns:
+                The host's reply, 'handshake' or 'transfer'
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            os.write(self.master, b'connect\n')
+            reply = self.read_line(timeout=.5)
+            if reply:
+                return reply.decode("utf-8", errors='replace')
+        return None
+
+    def session(self, timeout=None):
+        """ Runs a single session for whichever command the host replies with
+
+            :returns:
+                A dict of statistics for the session
+        """
+        reply = self.connect(timeout)
+        words = reply.split() if reply else []
+        if words[:1] == ['handshake']:
+            self.binary = 'binary' in words
+            skip = int(words[words.index('resume') + 1]) if 'resume' in words else 0
+            return self.send(skip)
+        elif reply == 'transfer':
+            return self.receive()
+        raise RuntimeError(f"unexpected reply from host: {reply!r}")
+
+    def records(self):
+        """ Yields the dataset one record at a time with '\\n' line endings """
+        with open(self.dataset, "rb") as f:
+            record = b''
+            for line in f:
+                record += line.rstrip(b'\r\n') + b'\n'
+                if record.count(b'\n') == 3:
+                    yield record
+                    record = b''
+            if record:
+                yield record
+
+    def poll_host(self, stats):
+        """ Handles anything the host sent while streaming
+
+            XOFF holds the output until XON, 'baud <rate>' lines are queued
+            to be answered at the next line boundary.
+        """
+        held = False
+        while True:
+            ready, _, _ = select.select([self.master], [], [], None if held else 0)
+            if not ready:
+                return
+            for byte in os.read(self.master, 64):
+                if byte == XOFF:
+                    held = True
+                    stats['held_off'] += 1
+                elif byte == XON:
+                    held = False
+                elif byte == ord('\n'):
+                    line, self.command = self.command, b''
+                    if line.startswith(b'baud '):
+                        self.proposals.append(int(line.split()[1]))
+                else:
+                    self.command += bytes([byte])
+
+    def change_rate(self, rate, stats):
+        """ Answers a baud proposal, switching if the host confirms the sync
+
+            :returns:
+                False if the rate was refused
+        """
+        if self.maxBaud and rate > self.maxBaud:
+            os.write(self.master, self.control(b'no %d' % rate))
+            return False
+        os.write(self.master, self.control(b'ok %d' % rate))
+        previous, self.rate = self.rate, rate
+        time.sleep(.05)
+        os.write(self.master, self.control(b'sync'))
+        reply = self.read_line(timeout=baudrate.SYNC_TIMEOUT + .5)
+        if reply is None or reply.strip(bytes([XON, XOFF])) != b'sync':
+            self.rate = previous
+        else:
+            stats['baud'] = rate
+            if self.baud:
+                self.baud = rate
+        return True
+
+    def pause(self, stats):
+        """ Pauses the stream, offering the host a baud rate change if negotiating """
+        os.write(self.master, self.control(b'pause'))
+        if not self.negotiate:
+            time.sleep(.01)
+            return
+        while True:
+            line = self.read_line(timeout=.5)
+            if line is None or not line.startswith(b'baud '):
+                return
+            if self.change_rate(int(line.split()[1]), stats):
+                return
+
+    def garble(self, data):
+        """ Corrupts data the way a link run faster than stableBaud would """
+        if not self.stableBaud or self.rate <= self.stableBaud:
+            return data
+        data = bytearray(data)
+        data[::997] = bytes([0xff]) * len(range(0, len(data), 997))
+        return data
+
+    def write(self, data, stats):
+        view = memoryview(data)
+        while view:
+            self.poll_host(stats)
+            if self.proposals and self.lineStart:
+                self.change_rate(self.proposals.pop(0), stats)
+                continue
+            chunk = view[:self.chunkSize]
+            if self.proposals and not self.binary:
+                # finish the current line so the answer starts a line of its own
+                chunk = bytes(chunk)
+                chunk = chunk[:chunk.find(b'\n') + 1] or chunk
+            n = os.write(self.master, self.garble(chunk))
+            # frames are only whole at the end of a write
+            self.lineStart = n == len(view) if self.binary else view[n - 1] == ord('\n')
+            view = view[n:]
+            stats['max_in_waiting'] = max(stats['max_in_waiting'], self.in_waiting())
+            if self.baud:
+                time.sleep(n * 10 / self.baud)
+
+    def blocks(self):
+        """ Yields the dataset in large blocks with '\\n' line endings """
+        with open(self.dataset, "rb") as f:
+            carry = b''
+            while True:
+                block = f.read(self.chunkSize * 16)
+                if not block:
+                    break
+                block = (carry + block).replace(b'\r\n', b'\n')
+                carry = b''
+                if block.endswith(b'\r'):
+                    block, carry = block[:-1], b'\r'
+                yield block
+            if carry:
+                yield carry
+
+    def control(self, word):
+        return binframe.encode_control(word) if self.binary else word + b'\n'
+
+    def encode(self, record):
+        header, sequence, _ = record.split(b'\n', 2)
+        return binframe.encode_record(header, sequence)
+
+    def encode_dataset(self):
+        """ Converts the dataset to blocks of whole frames, once per emulator """
+        self.encoded = []
+        block = bytearray()
+        records = 0
+        for record in self.records():
+            block += self.encode(record)
+            records += 1
+            if len(block) >= self.chunkSize * 16:
+                self.encoded.append((bytes(block), records))
+                block.clear()
+                records = 0
+        if block:
+            self.encoded.append((bytes(block), records))
+
+    def send(self, skip=0):
+        """ Streams the dataset after its first skip records to the host and ends with 'done' (or 'kill') """
+        stats = {'command': 'handshake', 'records': 0, 'bytes': 0, 'max_in_waiting': 0, 'held_off': 0,
+                 'baud': BASE_RATE, 'skipped': skip}
+        if self.binary and self.encoded is None:
+            self.encode_dataset()
+        stats['start'] = time.monotonic()
+        self.rate = BASE_RATE
+        self.lineStart = True
+        if self.negotiate:
+            self.pause(stats)
+        fast = not self.pauseEvery and not self.killAfter and not skip
+        if fast and self.binary:
+            for block, records in self.encoded:
+                self.write(block, stats)
+                stats['bytes'] += len(block)
+                stats['records'] += records
+            self.write(self.control(b'done'), stats)
+            stats['end'] = time.monotonic()
+            return stats
+        if fast:
+            lines = 0
+            for block in self.blocks():
+                self.write(block, stats)
+                stats['bytes'] += len(block)
+                lines += block.count(b'\n')
+            stats['records'] = lines // 3
+            self.write(b'done\n', stats)
+            stats['end'] = time.monotonic()
+            return stats
+
+        pending = bytearray()
+        for i, record in enumerate(self.records()):
+            if i < skip:
+                continue
+            if self.killAfter and stats['records'] == self.killAfter:
+                break
+            if self.binary:
+                record = self.encode(record)
+            pending += record
+            stats['records'] += 1
+            stats['bytes'] += len(record)
+            if self.pauseEvery and stats['records'] % self.pauseEvery == 0:
+                self.write(pending, stats)
+                pending.clear()
+                self.pause(stats)
+            elif len(pending) >= self.chunkSize:
+                self.write(pending, stats)
+                pending.clear()
+        last = b'kill' if self.killAfter and stats['records'] == self.killAfter else b'done'
+        self.write(pending + self.control(last), stats)
+        stats['end'] = time.monotonic()
+        return stats
+
+    def receive(self, out=None):
+        """ Reads the host's upload until 'done', optionally saving it to out """
+        stats = {'command': 'transfer', 'records': 0, 'bytes': 0, 'max_in_waiting': 0}
+        stats['start'] = time.monotonic()
+        tail = b''
+        while True:
+            stats['max_in_waiting'] = max(stats['max_in_waiting'], self.in_waiting(self.master))
+            data = os.read(self.master, 1 << 16)
+            data = tail + data
+            end = data.rfind(b'\n') + 1
+            lines, tail = data[:end], data[end:]
+            done = lines.endswith(b'done\n')
+            if done:
+                lines = lines[:-5]
+            stats['bytes'] += len(lines)
+            stats['records'] += lines.count(b'>')
+            if out:
+                out.write(lines)
+            if done:
+                break
+        stats['end'] = time.monotonic()
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mGRUE-emulator', description='Emulate an mGRUE device on a pseudo-terminal')
+    parser.add_argument('-f',
+                        '--file',
+                        help="dataset to send, a synthetic one is generated if not given")
+    parser.add_argument('-n',
+                        '--records',
+                        type=int,
+                        default=10000,
+                        help='number of records in the generated dataset. Default 10000.')
+    parser.add_argument('--length',
+                        type=int,
+                        default=150,
+                        help='mean sequence length of the generated dataset. Default 150.')
+    parser.add_argument('--generate',
+                        metavar='PATH',
+                        help='only write the generated dataset to PATH and exit')
+    parser.add_argument('--baud',
+                        type=int,
+                        help='pace output to this baud rate. Default unpaced.')
+    parser.add_argument('--negotiate',
+                        action='store_true',
+                        help='offer a baud rate change when streaming starts')
+    parser.add_argument('--max-baud',
+                        type=int,
+                        help='refuse baud proposals above this rate')
+    parser.add_argument('--stable-baud',
+                        type=int,
+                        help='garble data sent faster than this rate')
+    parser.add_argument('--pause-every',
+                        type=int,
+                        default=0,
+                        help="send 'pause' every N records")
+    parser.add_argument('--kill-after',
+                        type=int,
+                        default=0,
+                        help="send 'kill' after N records instead of finishing")
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_dataset(args.generate, args.records, args.length)
+        sys.exit(0)
+
+    dataset = args.file
+    if dataset is None:
+        dataset = f"/tmp/mgrue-{args.records}x{args.length}.fn"
+        if not os.path.isfile(dataset):
+            generate_dataset(dataset, args.records, args.length)
+
+    with Emulator(dataset, args.baud, args.pause_every, args.kill_after, negotiate=args.negotiate,
+                  maxBaud=args.max_baud, stableBaud=args.stable_baud) as emulator:
+        print(f"mGRUE emulator listening on {emulator.port}", flush=True)
+        while True:
+            stats = emulator.session()
+            seconds = stats['end'] - stats['start']
+            print(f"{stats['command']}: {stats['records']} records, {stats['bytes']} bytes in {seconds:.2f}s, "
+                  f"max in_waiting {stats['max_in_waiting']}", flush=True)
@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+
+MODES   = ['none', 'hardware', 'software']
+
+XON     = b'\x11'
+XOFF    = b'\x13'
+
+
+class FlowControl:
+    """ Asks the device to stop sending while the driver is behind
+
+        The writer queue is the driver's own buffer: once it is high full the
+        device is told to stop, and once the writer has drained it to low it
+        is told to carry on. 'hardware' drives RTS by hand, 'software' sends
+        XOFF/XON itself. The OS's XON/XOFF handling stays off: it would strip
+        every 0x11/0x13 byte from the incoming data, and binframe frames are
+        full of them. 'none' never throttles.
+
+        check() is called from both the reader and the writer thread.
+    """
+
+    def __init__(self, ser, mode='none', high=48, low=16):
+        self.ser        = ser
+        self.mode       = mode
+        self.high       = high
+        self.low        = low
+        self.lock       = threading.Lock()
+
+        self.asserted   = False
+        self.assertedAt = 0.0
+        self.count      = 0         # times the device was told to stop
+        self.heldTime   = 0.0       # seconds the device was held off in total
+
+        if mode == 'hardware':
+            self.ser.rtscts = False     # RTS is ours to drive, not the OS's
+            self.ser.rts = True
+        elif mode == 'software':
+            self.ser.xonxoff = False    # would eat 0x11/0x13 in the data, we send XOFF/XON ourselves
+
+    def check(self, depth):
+        if self.mode == 'none':
+            return
+        with self.lock:
+            if not self.asserted and depth >= self.high:
+                self.hold()
+            elif self.asserted and depth <= self.low:
+                self.release()
+
+    def hold(self):
+        if self.mode == 'hardware':
+            self.ser.rts = False
+        else:
+            self.ser.write(XOFF)
+        self.asserted = True
+        self.assertedAt = time.monotonic()
+        self.count += 1
+
+    def release(self):
+        if self.mode == 'hardware':
+            self.ser.rts = True
+        else:
+            self.ser.write(XON)
+        self.asserted = False
+        self.heldTime += time.monotonic() - self.assertedAt
+
+    def close(self):
+        if self.mode == 'none':
+            return
+        with self.lock:
+            if self.asserted:
+                self.release()
+        logging.info(f"Flow control ({self.mode}): device held off {self.count} times for {self.heldTime:.3f}s")
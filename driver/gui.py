@@ -2,171 +2,221 @@ import sys
 import time
 import threading
 import os
-import glob
 import serial
 
+import devices
+import discovery
+import receiver
+
 from PySide2.QtGui import QGuiApplication, QIcon
 from PySide2.QtQml import QQmlApplicationEngine
-from PySide2.QtCore import QObject, Slot, Signal
+from PySide2.QtCore import QObject, QTimer, Slot, Signal
 
 from datetime import datetime
 
 
+PUBLISH_INTERVAL = 100          # ms between status and progress updates to QML, 10 Hz
+RATE_SMOOTHING   = .3           # weight of the newest sample in the smoothed rates
+
+
 # Define our backend object, which we will pass to the engine object
 class Backend(QObject):
     recordsPerFile = 4000        # Set max number of records that will be written to each file here
+    flowControl = 'none'         # 'hardware' or 'software' to hold the device off when the disk falls behind
+    negotiateBaud = False        # agree a faster baud rate with the device when it pauses
+    maxBaud = None
+    binary = False               # ask the device for binframe frames instead of text
+    allDevices = False           # capture from every connected device, each into its own subfolder
+    resume = False               # checkpoint transfers and carry on from the last one after an interruption
+    index = False                # write a recordindex sidecar next to each output file
+    compress = 'none'            # compression.FORMATS, applied to each output file once it is finished
+    qc = False                   # keep a running qc.Summary of the output files
+    trace = None                 # folder every transfer's reads are recorded to, see serialtrace.py
+    metrics = None               # metrics.Registry the transfers are reported to
+    sinks = []                   # sinks.py outputs records are also streamed to
+    files = True                 # write records to disk, False to only stream them to the sinks
+    expectedRecords = 0          # records a transfer is expected to hold, for the ETA, 0 if not known
     currentStatus = ""
     status = Signal(str)
+    progress = Signal('QVariantMap')
     quick  = True
 
-    def __init__(self):
+    def __init__(self, deviceFilter=None):
         super().__init__()
 
         self.destination_folder = ""
-
-    # This function is sending data to the frontend (uses the status signal)
+        self.deviceFilter = deviceFilter
+        self.discovery = discovery.Discovery(deviceFilter)
+        self.manager = None
+        self.receiver = None            # the Receiver of the transfer in progress
+        self.publishedStatus = None
+        self.lastSample = None          # (time, bytes, records) at the last publish
+        self.byteRate = 0.0
+        self.recordRate = 0.0
+
+    # This function records the status for the frontend; publish() passes it on
+    # from the GUI thread, so the reader thread never emits signals itself
     def update_status(self, msg):
-        # Pass the current status message to QML.
         self.currentStatus = msg
-        self.status.emit(msg)
+
+    # This function runs every PUBLISH_INTERVAL ms on the GUI thread and sends
+    # QML the status, if it changed, and the progress of the transfers running
+    @Slot()
+    def publish(self):
+        if self.currentStatus != self.publishedStatus:
+            self.publishedStatus = self.currentStatus
+            self.status.emit(self.currentStatus)
+
+        receivers = self.active_receivers()
+        records = sum(r.records + (r.resumed.records if r.resumed else 0) for r in receivers)
+        received = sum(r.bytesRead for r in receivers)
+        now = time.monotonic()
+        if self.lastSample and receivers and now > self.lastSample[0]:
+            then, receivedThen, recordsThen = self.lastSample
+            elapsed = now - then
+            self.byteRate += RATE_SMOOTHING * ((received - receivedThen) / elapsed - self.byteRate)
+            self.recordRate += RATE_SMOOTHING * ((records - recordsThen) / elapsed - self.recordRate)
+        elif not receivers:
+            self.byteRate = self.recordRate = 0.0
+        self.lastSample = (now, received, records)
+
+        eta = -1
+        if self.expectedRecords and self.recordRate > 0:
+            eta = max(self.expectedRecords - records, 0) / self.recordRate
+        self.progress.emit({
+            'active': len(receivers),
+            'state': receivers[0].state if len(receivers) == 1 else -1,
+            'records': records,
+            'bytes': received,
+            'bytesPerSecond': self.byteRate,
+            'recordsPerSecond': self.recordRate,
+            'expected': self.expectedRecords,
+            'eta': eta,
+            'file': os.path.basename(receivers[0].writer.file_name()) if len(receivers) == 1 else "",
+        })
+
+    def active_receivers(self):
+        if self.manager:
+            return [r for r in (s.receiver for s in list(self.manager.sessions.values())) if r]
+        return [self.receiver] if self.receiver else []
     
     #This function sets the max records per file based on user input
     def update_records(self,n):
         self.recordsPerFile = n
 
+    #This function sets the flow control mode, see flowcontrol.MODES
+    def update_flow_control(self, mode):
+        self.flowControl = mode
+
+    #This function switches between the text and binary protocol
+    def update_binary(self, binary):
+        self.binary = binary
+
+    #This function switches between capturing from one device and from all of them
+    def update_all_devices(self, allDevices):
+        self.allDevices = allDevices
+
+    #This function turns checkpointing and resuming of interrupted transfers on or off
+    def update_resume(self, resume):
+        self.resume = resume
+
+    #This function turns the record index sidecars on or off
+    def update_index(self, index):
+        self.index = index
+
+    #This function sets the output compression, see compression.FORMATS
+    def update_compression(self, fmt):
+        self.compress = fmt
+
+    #This function turns the QC summary of finished output files on or off
+    def update_qc(self, qc):
+        self.qc = qc
+
+    #This function sets where the reads of each transfer are recorded, None to not record them
+    def update_trace(self, folder):
+        self.trace = folder
+
+    #This function sets where transfers report their throughput and health figures
+    def update_metrics(self, registry):
+        self.metrics = registry
+
+    #This function sets where records are streamed as they arrive, and whether they are written to disk
+    def update_sinks(self, outputs, files=True):
+        self.sinks = outputs
+        self.files = files
+
+    #This function sets how many records a transfer is expected to hold, for the ETA
+    def update_expected_records(self, n):
+        self.expectedRecords = n or 0
+
+    #This function turns baud rate negotiation on or off
+    def update_baud_negotiation(self, negotiate, maxBaud=None):
+        self.negotiateBaud = negotiate
+        self.maxBaud = maxBaud
+
     # This function is getting data from frontend
     @Slot(str)
     def getFileLocation(self, location):
         print("User selected: " + location[7:])
         self.destination_folder = location[7:]
+        if self.manager:
+            self.manager.destination = self.destination()
     
+    def destination(self):
+        if os.name == 'nt':
+            return self.destination_folder[1:]
+        return self.destination_folder
+
+    def receiver_options(self):
+        return dict(flowControl=self.flowControl, negotiateBaud=self.negotiateBaud,
+                    maxBaud=self.maxBaud, binary=self.binary, resume=self.resume,
+                    index=self.index, compress=self.compress, metrics=self.metrics, sinks=self.sinks,
+                    files=self.files, qc=self.qc, trace=self.trace)
+
     def serial_ports(self):
-        """ Lists serial port names
-
-            :raises EnvironmentError:
-                On unsupported or unknown platforms
-            :returns:
-                A list of the serial ports available on the system
-        """
-        if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 2) for i in range(255)]
-        elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-            # this excludes your current terminal "/dev/tty"
-            ports = glob.glob('/dev/tty[A-Za-z]*')
-        elif sys.platform.startswith('darwin'):
-            ports = glob.glob('/dev/tty.*')
-        else:
-            raise EnvironmentError('Unsupported platform')
-
-        result = []
-        for port in ports:
-            try:
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except (OSError, serial.SerialException):
-                pass
-        return result
+        """ Lists the ports of connected mGRUE devices, best match first """
+        return self.discovery.find_devices()
+
+    def find_device(self):
+        self.update_status("Looking for MGRUE device...")
+        port = self.discovery.wait_for_device(timeout=5)
+        while port is None:
+            print("No MGRUE device found")
+            self.update_status("no MGRUE device found")
+            port = self.discovery.wait_for_device(timeout=15)
+        return port
 
     def readStarter(self):
-        open_ports = []
-        count = 0
-
-        while not open_ports:
-            open_ports = self.serial_ports()
-            time.sleep(.1)
-            count += 1
-            self.update_status("Looking for MGRUE device...")
-            if count == 50:
-                print("No MGRUE device found")
-                self.update_status("no MGRUE device found")
-                time.sleep(10)
-                count = 0
-
-        self.update_status("Awaiting command from device...")
+        if self.allDevices:
+            self.manager = devices.DeviceManager(self.destination(), self.recordsPerFile, self.receiver_options(),
+                                                 self.deviceFilter, status=self.update_status)
+            self.manager.run()
+            return
         while True:
-            self.quickReadSerial(open_ports[0])
+            port = self.find_device()
+            self.update_status("Awaiting command from device...")
+            try:
+                while True:
+                    self.quickReadSerial(port)
+            except serial.SerialException as e:     # unplugged or can't be opened, go back to waiting for it
+                print(f"{port}: {e}")
+                self.update_status(f"Could not use {port}: {e}")
+                self.discovery.invalidate()
+                time.sleep(devices.RETRY_INTERVAL)  # a port we may not open would come straight back
 
     def quickReadSerial(self, port):
         with serial.Serial(port, 921600, timeout=1) as ser:
             while (True):
-                stillReading    = True
-                curTime         = datetime.now().strftime("%H-%M-%S")
-                sequenceNum     = 0
-                fileCounter     = 0
-                bytesMessage    = ser.readline().decode("utf-8", errors='replace')[:-1]     # read a '\n' terminated line, removing the \n
-                file            = 0
-                sequence        = 0
-                whiteline       = 0
-                count           = 0
-                leftover        = 0
-                lines           = []
+                bytesMessage = receiver.read_command(ser)
 
                 if bytesMessage == 'connect' and self.destination_folder != "":
-                    ser.write(b'handshake\n')
-                    self.update_status("Device Connected")
-                    
-                    if os.name == 'nt':
-                        file = open(self.destination_folder[1:] + "/" + curTime + "_file" + str(fileCounter) + ".fn", "a", encoding="utf-8", errors='ignore')
-                    else:
-                        file = open(self.destination_folder + "/" + curTime + "_file" + str(fileCounter) + ".fn", "w", encoding="utf-8", errors='ignore')
-                    self.update_status("Data transfer in progress....")
-                    while (self.currentStatus != "Data transfer complete! Awaiting new action..."):
-                        while (self.currentStatus != "Data transfer complete! Awaiting new action..."):
-                            bytesMessage = ser.read(ser.in_waiting).decode("utf-8", errors='replace')
-                            
-                            if self.currentStatus == "Paused.":
-                                if 'kill' in bytesMessage:
-                                    self.update_status("Transfer was stopped early. Awaiting new command...")
-                                    file.close()
-                                    return
-                                else:
-                                    self.update_status("Data transfer in progress....")
-                            lines = bytesMessage.split('\n')
-                            if leftover:
-                                lines[0] = leftover + lines[0]
-                                leftover = ""
-
-                            print("Bytes in waiting %s" %(ser.in_waiting), end="\r")
-                            for line in lines[:-1]:
-                                if 'done' in line:
-                                    self.update_status("Data transfer complete! Awaiting new action...")
-                                    file.close()
-                                    return
-                                if 'pause' in line:       # Pauses the transfer for a baud rate change
-                                    self.update_status("Paused.")
-                                    lines.remove(line)
-                                elif 'kill' in line:
-                                    self.update_status("Transfer was stopped early. Awaiting new command...")
-                                    file.close()
-                                    return
-                                else:
-                                    file.write(line + "\r\n")
-                                    count += 1
-                                    if count % 3 == 0 and count / 3 == self.recordsPerFile:
-                                        fileCounter += 1
-                                        if os.name == 'nt':
-                                            file.close()
-                                            file = open(self.destination_folder[1:] + "/" + curTime + "_file" + str(fileCounter) + ".fn", "a", encoding="utf-8", errors='ignore')
-                                        else:
-                                            file.close()
-                                            file = open(self.destination_folder + "/" + curTime + "_file" + str(fileCounter) + ".fn", "w", encoding="utf-8", errors='ignore')
-                                        count = 0
-                            
-                            leftover = lines[-1]
-
-                            if 'done' in leftover:
-                                self.update_status("Data transfer complete! Awaiting new action...")
-                                file.close()
-                                return
-                            
-                        # if self.currentStatus == "Paused.":
-                        #     bytesMessage = ser.readline().decode("utf-8", errors='replace')
-                        #     if bytesMessage:
-                        #         self.update_status("Data transfer in progress....")
-                        #         file.write(bytesMessage)
-
-                    
+                    self.receiver = receiver.Receiver(ser, self.destination(), self.recordsPerFile,
+                                                      status=self.update_status, **self.receiver_options())
+                    try:
+                        self.receiver.run()
+                    finally:
+                        self.receiver = None
+                    return
 
     def readSerial(self):
         open_ports = self.serial_ports()
@@ -257,7 +307,10 @@ class Backend(QObject):
                 #time.sleep(.01)
 
 
-def init(recordsPerFile):
+def init(recordsPerFile, deviceFilter=None, flowControl='none', negotiateBaud=False, maxBaud=None,
+         binary=False, allDevices=False, resume=False, index=False,
+         compress='none', metrics=None, expectedRecords=0, outputs=None, files=True, qc=False,
+         trace=None):
     app = QGuiApplication(sys.argv)
 
     # Added to avoid runtime warnings
@@ -272,11 +325,26 @@ def init(recordsPerFile):
     engine.quit.connect(app.quit)
 
     # Get QML File context
-    backend = Backend()
+    backend = Backend(deviceFilter)
     engine.rootObjects()[0].setProperty('backend', backend)
     backend.update_records(recordsPerFile)
+    backend.update_flow_control(flowControl)
+    backend.update_baud_negotiation(negotiateBaud, maxBaud)
+    backend.update_binary(binary)
+    backend.update_all_devices(allDevices)
+    backend.update_resume(resume)
+    backend.update_index(index)
+    backend.update_compression(compress)
+    backend.update_qc(qc)
+    backend.update_trace(trace)
+    backend.update_metrics(metrics)
+    backend.update_expected_records(expectedRecords)
+    backend.update_sinks(outputs or [], files)
 
     backend.update_status("Awaiting Connection")
+    timer = QTimer()
+    timer.timeout.connect(backend.publish)
+    timer.start(PUBLISH_INTERVAL)
     #thread = threading.Thread(target=backend.readSerial, args=())
     thread = threading.Thread(target=backend.readStarter, args=())
     thread.start()
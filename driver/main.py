@@ -1,12 +1,21 @@
 import argparse
+import atexit
 import logging
 import os
+import signal
 import sys
-import time
-import glob
-from datetime import datetime
 import serial
 
+import compression
+import daemon
+import devices
+import discovery
+import flowcontrol
+import metrics
+import receiver
+import sinks
+import transfer
+
 
 def valid_path(path):
     if path == './output':
@@ -21,53 +30,31 @@ def valid_path(path):
 def valid_file(path):
     if path == '':
         raise argparse.ArgumentTypeError(f"Path cannot be empty")
-    if path == './output':
-        if not os.path.isdir(path):
-            os.mkdir('output')
-            return path
-    if os.path.isfile(path):
-        if path.endswith('.fn'):
-            return path
-        else:
-            raise argparse.ArgumentTypeError(f"{path} is not a valid file type")
-    else:
-        raise argparse.ArgumentTypeError(f"{path} is not a valid file")
-
-def serial_ports():
-        """ Lists serial port names
-
-            :raises EnvironmentError:
-                On unsupported or unknown platforms
-            :returns:
-                A list of the serial ports available on the system
-        """
-        if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 2) for i in range(255)]
-        elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-            # this excludes your current terminal "/dev/tty"
-            ports = glob.glob('/dev/tty[A-Za-z]*')
-        elif sys.platform.startswith('darwin'):
-            ports = glob.glob('/dev/tty.*')
-        else:
-            raise EnvironmentError('Unsupported platform')
-
-        result = []
-        for port in ports:
-            try:
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except (OSError, serial.SerialException):
-                pass
-        return result
+    try:
+        return transfer.expand_inputs(path)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def find_device(finder):
+    """ Waits for an mGRUE device, warning every so often while none is plugged in
+
+        :returns:
+            The port of the device
+    """
+    logging.info(f"Looking for mGRUE device...")
+    port = finder.wait_for_device(timeout=5)
+    while port is None:
+        logging.warning(f"no mGRUE device found")
+        port = finder.wait_for_device(timeout=15)
+    return port
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='mGRUE-driver', description='Initialize the mGRUE Host Device Driver')
     parser.version = '1.0'
     parser.add_argument('mode',
-                        choices=['gui', 'cli', 'transfer'],
+                        choices=['gui', 'cli', 'transfer', 'daemon'],
                         default='cli',
-                        help='option to use program through a GUI or via Command Line')
+                        help='option to use program through a GUI or via Command Line, or to run in the background controlled through --socket')
     parser.add_argument('-l',
                         '--location',
                         type=valid_path,
@@ -77,165 +64,181 @@ if __name__ == '__main__':
     parser.add_argument('-f',
                         '--file',
                         type=valid_file,
-                        nargs='?',
-                        help="data file to replace the file that is sent to the driver")
+                        action='append',
+                        help="data to send in transfer mode: a .fn, .fn.gz or .fn.xz file, a directory of them or a quoted glob pattern. "
+                             "Give it more than once to send several, one after the other.")
     parser.add_argument('-r',
                         '--records',
                         type=int,
                         nargs='?',
                         default=4000,
                         help='the number of records per file. Default 4000.')
+    parser.add_argument('-b',
+                        '--block-size',
+                        type=int,
+                        default=transfer.BLOCK_SIZE,
+                        help=f'bytes read and sent at a time in transfer mode. Default {transfer.BLOCK_SIZE}.')
+    parser.add_argument('--flow-control',
+                        choices=flowcontrol.MODES,
+                        default='none',
+                        help='hold the device off with RTS (hardware) or XOFF (software) when the driver falls behind. Default none.')
+    parser.add_argument('--negotiate-baud',
+                        action='store_true',
+                        help='agree a faster baud rate with the device when it pauses')
+    parser.add_argument('--max-baud',
+                        type=int,
+                        help='fastest baud rate to propose when negotiating')
+    parser.add_argument('--binary',
+                        action='store_true',
+                        help='ask the device for compact binary frames instead of text')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='checkpoint transfers as they go and ask the device to carry on from the last one after a kill, disconnect or crash')
+    parser.add_argument('--index',
+                        action='store_true',
+                        help='write a record index (<file>.fn.idx) next to each output file, see recordindex.py')
+    parser.add_argument('--compress',
+                        choices=compression.FORMATS,
+                        default='none',
+                        help='compress each output file once it is finished, using all cores. Default none.')
+    parser.add_argument('--qc',
+                        action='store_true',
+                        help='work out read counts, lengths, N50, GC and N content of each output file once it is finished, into <time>_qc.json')
+    parser.add_argument('--sink',
+                        action='append',
+                        help='also stream records as they arrive to stdout, fifo:<path> or socket:<path>. May be given more than once.')
+    parser.add_argument('--sink-policy',
+                        choices=sinks.POLICIES,
+                        help='what to do when a sink reader falls --sink-buffer chunks behind: wait for it, or drop records for it. '
+                             'Default drop, or block with --no-files; block needs --no-files, so a sink never holds up the output files.')
+    parser.add_argument('--sink-buffer',
+                        type=int,
+                        default=sinks.QUEUE_SIZE,
+                        help=f'chunks of records a sink reader may fall behind by. Default {sinks.QUEUE_SIZE}.')
+    parser.add_argument('--no-files',
+                        action='store_true',
+                        help='only stream to the sinks, write nothing to disk')
+    parser.add_argument('--trace',
+                        type=valid_path,
+                        metavar='DIR',
+                        help='record every read from the port to a trace file in DIR, for replaying with serialtrace.py')
+    parser.add_argument('--expected-records',
+                        type=int,
+                        help='records a transfer is expected to hold, lets the GUI show progress and an ETA')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help='serve live throughput and health figures on this local port, at /metrics (Prometheus) and /stats.json')
+    parser.add_argument('--stats-file',
+                        help='append a JSON line of the same figures to this file every --stats-interval seconds')
+    parser.add_argument('--stats-interval',
+                        type=float,
+                        default=metrics.STATS_INTERVAL,
+                        help=f'seconds between lines of the stats file. Default {metrics.STATS_INTERVAL}.')
+    parser.add_argument('--socket',
+                        default=daemon.SOCKET_PATH,
+                        help=f'control socket of daemon mode, see daemon.py. Default {daemon.SOCKET_PATH}.')
+    parser.add_argument('-p',
+                        '--port',
+                        action='append',
+                        help='serial port of the mGRUE device, skips device discovery. Give it more than once to capture from several ports.')
+    parser.add_argument('--all-devices',
+                        action='store_true',
+                        help='capture from every matching device at once, each into its own subfolder of the destination')
+    parser.add_argument('--vid',
+                        type=discovery.parse_id,
+                        help='only use devices with this USB vendor id (hex)')
+    parser.add_argument('--pid',
+                        type=discovery.parse_id,
+                        help='only use devices with this USB product id (hex)')
+    parser.add_argument('--serial-number',
+                        help='only use the device with this USB serial number')
     args = parser.parse_args()
-
-    if args.location == '' or args.file == '':
-        print('ERROR: Please specify a valid location and file')
+    if args.no_files and not args.sink:
+        parser.error("--no-files needs at least one --sink")
+    if args.sink_policy == 'block' and not args.no_files:
+        parser.error("--sink-policy block would hold up the output files behind a slow reader, it needs --no-files")
+    if args.sink_policy is None:
+        args.sink_policy = 'block' if args.no_files else 'drop'
+    if args.no_files and (args.resume or args.index or args.compress != 'none' or args.qc):
+        parser.error("--resume, --index, --compress and --qc work on output files, they can't be used with --no-files")
+
+    if args.location == '':
+        print('ERROR: Please specify a valid location')
         sys.exit(1)
+    if args.mode == 'transfer' and not args.file:
+        parser.error("transfer mode needs the files to send, see -f")
+    inputs = [path for paths in args.file or [] for path in paths]
     recordsPerFile = args.records
     destinationFolder = args.location
     
 
     logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    # exit normally on SIGTERM so the atexit cleanup runs, e.g. workers.shutdown()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    deviceFilter = discovery.DeviceFilter(args.vid, args.pid, args.serial_number)
+    registry = None
+    if args.metrics_port is not None or args.stats_file:
+        registry = metrics.Registry(args.stats_file, args.stats_interval)
+        registry.start()
+        if args.metrics_port is not None:
+            registry.serve(args.metrics_port)
+    try:
+        outputs = [sinks.open_sink(spec, args.sink_buffer, args.sink_policy) for spec in args.sink or []]
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    for output in outputs:
+        atexit.register(output.close)       # lets the readers take what is still queued, removes socket files
+    options = dict(flowControl=args.flow_control, negotiateBaud=args.negotiate_baud,
+                   maxBaud=args.max_baud, binary=args.binary, resume=args.resume,
+                   index=args.index, compress=args.compress, metrics=registry, sinks=outputs,
+                   files=not args.no_files, qc=args.qc, trace=args.trace)
+    multiDevice = args.all_devices or (args.port is not None and len(args.port) > 1)
 
     if(args.mode == 'gui'):
         import gui
-        gui.init(recordsPerFile)
+        gui.init(recordsPerFile, deviceFilter, args.flow_control, args.negotiate_baud, args.max_baud, args.binary,
+                 allDevices=args.all_devices, resume=args.resume, index=args.index,
+                 compress=args.compress, metrics=registry, expectedRecords=args.expected_records,
+                 outputs=outputs, files=not args.no_files, qc=args.qc, trace=args.trace)
     elif(args.mode == 'transfer'):
-        open_ports = []
-        count = 0
-        logging.info(f"Looking for mGRUE device...")
-
-        while not open_ports:
-            open_ports = serial_ports()
-            time.sleep(.1)
-            count += 1
-            if count == 50:
-                logging.warning(f"no mGRUE device found")
-                time.sleep(10)
-                count = 0
-                logging.info(f"Looking for mGRUE device...")
-
+        port = args.port[0] if args.port else find_device(discovery.Discovery(deviceFilter))
 
         currentStatus = "Port opened, found mGRUE device"
         logging.info(f"{currentStatus}")   
-        with serial.Serial(open_ports[0], 921600, timeout=1) as ser:
+        with serial.Serial(port, 921600, timeout=1) as ser:
             while (True):
-                stillReading    = True
-                curTime         = datetime.now().strftime("%H-%M-%S")
-                sequenceNum     = 0
-                fileCounter     = 0
-                bytesMessage    = ser.readline().decode("utf-8", errors='replace')[:-1]     # read a '\n' terminated line, removing the \n
-                file            = 0
-                sequence        = 0
-                whiteline       = 0
-                count           = 0
-                leftover        = 0
-                lines           = []
+                bytesMessage = receiver.read_command(ser)
 
                 if bytesMessage == 'connect':
                     ser.write(b'transfer\n')
                     currentStatus = "Device Connected"
                     logging.info(f"{currentStatus}")
-                    with open(args.file, "r") as f:
-                        for line in f.readlines():
-                            #print(line[:-1])
-                            ser.write((line).encode("utf-8"))
-                    ser.write(b"done\n")          
+                    uploader = transfer.Uploader(ser, args.block_size, progress=transfer.log_progress(logging.info))
+                    uploader.upload_files(inputs)
+                    ser.write(b"done\n")
                     currentStatus = "Transfer Complete"
                     logging.info(f"{currentStatus}")
+                    logging.info(uploader.summary())
                     exit()
+    elif(args.mode == 'daemon'):
+        logging.info(f"File Destination Path -> {destinationFolder}" + ("/<device>" if multiDevice else ""))
+        manager = devices.DeviceManager(destinationFolder, recordsPerFile, options, deviceFilter, ports=args.port,
+                                        single=not multiDevice)
+        daemon.Daemon(manager, args.socket).run()
+    elif multiDevice:
+        logging.info(f"File Destination Path -> {destinationFolder}/<device>")
+        devices.DeviceManager(destinationFolder, recordsPerFile, options, deviceFilter, ports=args.port).run()
     else:
-        open_ports = []
-        count = 0
-        logging.info(f"Looking for mGRUE device...")
-
-        while not open_ports:
-            open_ports = serial_ports()
-            time.sleep(.1)
-            count += 1
-            if count == 50:
-                logging.warning(f"no mGRUE device found")
-                time.sleep(10)
-                count = 0
-                logging.info(f"Looking for mGRUE device...")
-                
+        port = args.port[0] if args.port else find_device(discovery.Discovery(deviceFilter))
+
         logging.info(f"File Destination Path -> {destinationFolder}")
 
         currentStatus = "Port opened, found mGRUE device"
         logging.info(f"{currentStatus}")
 
-        with serial.Serial(open_ports[0], 921600, timeout=1) as ser:
+        with serial.Serial(port, 921600, timeout=1) as ser:
             while (True):
-                stillReading    = True
-                curTime         = datetime.now().strftime("%H-%M-%S")
-                sequenceNum     = 0
-                fileCounter     = 0
-                bytesMessage    = ser.readline().decode("utf-8", errors='replace')[:-1]     # read a '\n' terminated line, removing the \n
-                file            = 0
-                sequence        = 0
-                whiteline       = 0
-                count           = 0
-                leftover        = 0
-                lines           = []
+                bytesMessage = receiver.read_command(ser)
 
                 if bytesMessage == 'connect' and destinationFolder != "":
-                    ser.write(b'handshake\n')
-                    currentStatus = "Device Connected"
-                    logging.info(f"{currentStatus}")
-                    
-                    if os.name == 'nt':
-                        file = open(destinationFolder + "/" + curTime + "_file" + str(fileCounter) + ".fn", "a", encoding="utf-8", errors='ignore')
-                    else:
-                        file = open(destinationFolder + "/" + curTime + "_file" + str(fileCounter) + ".fn", "w", encoding="utf-8", errors='ignore')
-                    currentStatus = "Data transfer in progress...."
-                    logging.info(f"{currentStatus}")
-                    while (currentStatus != "Data transfer complete! Awaiting new action..." and \
-                            currentStatus != "Transfer was stopped early. Awaiting new command..."):
-                        while (currentStatus != "Data transfer complete! Awaiting new action..." and \
-                                currentStatus != "Transfer was stopped early. Awaiting new command..."):
-                            bytesMessage = ser.read(ser.in_waiting).decode("utf-8", errors='replace')
-                            if currentStatus == "Paused.":
-                                currentStatus = "Data transfer in progress...."
-                            lines = bytesMessage.split('\n')
-                            if leftover:
-                                lines[0] = leftover + lines[0]
-                                leftover = ""
-
-                            # print("INFO: Bytes in waiting: %s" %(ser.in_waiting), end="\r")
-                            if ser.in_waiting > 0:
-                                logging.debug("Bytes in waiting %s." %(ser.in_waiting))
-                            for line in lines[:-1]:
-                                if 'done' in line:
-                                    currentStatus = "Data transfer complete! Awaiting new action..."
-                                    logging.info(f"{currentStatus}")
-                                    file.close()         # I have no idea why on god's green earth this breaks here but not in the gui. 
-                                if 'pause' in line:       # Pauses the transfer for a baud rate change
-                                    currentStatus = "Paused."
-                                    logging.info(f"{currentStatus}")
-                                    lines.remove(line)
-                                elif 'kill' in line:
-                                    currentStatus = "Transfer was stopped early. Awaiting new command..."
-                                    logging.info(f"{currentStatus}")
-                                    file.close()
-                                else:
-                                    try:
-                                        file.write(line + "\r\n")
-                                        count += 1
-                                        if count % 3 == 0 and count / 3 == recordsPerFile:
-                                            fileCounter += 1
-                                            if os.name == 'nt':
-                                                file.close()
-                                                file = open(destinationFolder + "/" + curTime + "_file" + str(fileCounter) + ".fn", "a", encoding="utf-8", errors='ignore')
-                                            else:
-                                                file.close()
-                                                file = open(destinationFolder + "/" + curTime + "_file" + str(fileCounter) + ".fn", "w", encoding="utf-8", errors='ignore')
-                                            count = 0
-                                    except:
-                                        pass
-                                    
-                            
-                            leftover = lines[-1]
-
-                            if 'done' in leftover:
-                                currentStatus = "Data transfer complete! Awaiting new action..."
-                                logging.info(f"{currentStatus}")
-                                file.close()
+                    receiver.Receiver(ser, destinationFolder, recordsPerFile, status=logging.info, **options).run()
@@ -12,6 +12,7 @@ Window {
     color: "lightslategrey"
     property string fileName: "Please select a location"
     property string statusMessage: ""
+    property var progress: ({})
     property QtObject backend
 
     Connections {
@@ -19,6 +20,17 @@ Window {
         function onStatus(msg) {
             statusMessage = msg;
         }
+        function onProgress(p) {
+            progress = p;
+        }
+    }
+
+    function formatEta(seconds) {
+        if (seconds < 0)
+            return "";
+        var m = Math.floor(seconds / 60);
+        var s = Math.floor(seconds % 60);
+        return "  ETA " + m + ":" + (s < 10 ? "0" : "") + s;
     }
 
     Rectangle {
@@ -45,7 +57,7 @@ Window {
             Text {
                 id: location
                 anchors {
-                    bottom: messages.top
+                    bottom: progressBar.top
                     bottomMargin: 12
                     left: messages.left
 
@@ -55,6 +67,36 @@ Window {
                 font.family: "Yu Gothic UI Semilight"
                 color: "oldlace"
             }
+            Text {
+                id: progressText
+                visible: progress.active > 0
+                anchors {
+                    bottom: messages.top
+                    bottomMargin: 6
+                    left: messages.left
+                }
+                text: progress.records + " records, " + (progress.bytes / 1048576).toFixed(1) + " MiB  "
+                      + Math.round(progress.recordsPerSecond) + " records/s"
+                      + formatEta(progress.eta)
+                      + (progress.file ? "  " + progress.file : "")
+                font.pixelSize: 18
+                font.family: "Yu Gothic UI Semilight"
+                color: "oldlace"
+            }
+            ProgressBar {
+                id: progressBar
+                visible: progress.active > 0 && progress.expected > 0
+                anchors {
+                    bottom: progressText.top
+                    bottomMargin: 6
+                    left: messages.left
+                    right: parent.right
+                    rightMargin: 12
+                }
+                from: 0
+                to: progress.expected > 0 ? progress.expected : 1
+                value: progress.records
+            }
             Text {
                 id: messages
                 anchors {
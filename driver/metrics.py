@@ -0,0 +1,192 @@
+import http.server
+import json
+import logging
+import threading
+import time
+
+
+SAMPLE_INTERVAL = 1             # seconds between samples the rates are worked out from
+STATS_INTERVAL  = 10            # seconds between lines of the stats file
+
+# name, Prometheus type, help; the counters of every device in a snapshot
+METRICS = [
+    ('bytes_received_total',        'counter',  "Bytes read from the serial port"),
+    ('records_received_total',      'counter',  "Complete records written"),
+    ('sessions_total',              'counter',  "Transfers started"),
+    ('bytes_per_second',            'gauge',    "Bytes read per second over the last sample"),
+    ('records_per_second',          'gauge',    "Records written per second over the last sample"),
+    ('read_max_bytes',              'gauge',    "Largest single read, the high-water mark of the port's in_waiting"),
+    ('crc_errors_total',            'counter',  "Binary frames dropped for a failed CRC"),
+    ('skipped_bytes_total',         'counter',  "Bytes thrown away looking for a frame start"),
+    ('baud_fallbacks_total',        'counter',  "Negotiated baud rates given up on"),
+    ('baud',                        'gauge',    "Current baud rate of the link"),
+    ('files_total',                 'counter',  "Output files started"),
+    ('bytes_written_total',         'counter',  "Bytes written to output files"),
+    ('rotation_seconds_total',      'counter',  "Seconds spent closing and opening output files"),
+    ('rotation_max_seconds',        'gauge',    "Longest single file rotation"),
+    ('writer_stall_seconds_total',  'counter',  "Seconds the reader waited on a full writer queue"),
+    ('writer_queue_max_depth',      'gauge',    "Most chunks waiting for the writer at once"),
+    ('flow_control_holds_total',    'counter',  "Times the device was told to stop sending"),
+    ('active',                      'gauge',    "1 while a transfer is in progress"),
+]
+
+# counters a finished session adds to its device's running totals
+TOTALS = ['bytes_received_total', 'records_received_total', 'sessions_total', 'crc_errors_total',
+          'skipped_bytes_total', 'baud_fallbacks_total', 'files_total', 'bytes_written_total',
+          'rotation_seconds_total', 'writer_stall_seconds_total', 'flow_control_holds_total']
+
+
+def session_stats(receiver):
+    """ Reads the counters of one receiver.Receiver
+
+        Nothing here is updated for the sake of metrics: the numbers are the
+        ones the receiver, its writer and decoders keep anyway, read from
+        another thread when a sample is taken.
+    """
+    out = receiver.writer
+    flow = out.flow
+    return {
+        'bytes_received_total':         receiver.bytesRead,
+        'records_received_total':       receiver.records,
+        'sessions_total':               1,
+        'read_max_bytes':               receiver.maxRead,
+        'crc_errors_total':             receiver.decoder.crcErrors if receiver.decoder else 0,
+        'skipped_bytes_total':          receiver.decoder.skipped if receiver.decoder else 0,
+        'baud_fallbacks_total':         receiver.negotiator.fallbacks if receiver.negotiator else 0,
+        'baud':                         receiver.ser.baudrate,
+        'files_total':                  out.fileCounter + 1,
+        'bytes_written_total':          out.bytesWritten,
+        'rotation_seconds_total':       out.rotateTime,
+        'rotation_max_seconds':         out.maxRotate,
+        'writer_stall_seconds_total':   out.stallTime,
+        'writer_queue_max_depth':       out.maxDepth,
+        'flow_control_holds_total':     flow.count if flow else 0,
+        'status':                       receiver.currentStatus,
+    }
+
+
+class Registry:
+    """ Live throughput and health figures for every device the driver talks to
+
+        Receivers register while a transfer runs, and their counters are
+        added to per device totals when it ends. A sampler thread reads
+        them every SAMPLE_INTERVAL seconds, works out rates, and keeps the
+        result for the HTTP endpoint (serve()) and appends it to the stats
+        file every STATS_INTERVAL seconds. Reading happens only on the
+        sampler thread, so the receive loop pays nothing for it.
+    """
+
+    def __init__(self, statsFile=None, statsInterval=STATS_INTERVAL):
+        self.lock           = threading.Lock()
+        self.active         = {}        # device name -> receiver.Receiver
+        self.totals         = {}        # device name -> counters of its finished sessions
+        self.previous       = {}        # device name -> (time, bytes, records) of the last sample
+        self.latest         = {}        # the last snapshot()
+        self.statsFile      = statsFile
+        self.statsInterval  = statsInterval
+        self.started        = time.time()
+        self.thread         = threading.Thread(target=self.run, name="mgrue-metrics", daemon=True)
+        self.server         = None
+
+    def start(self):
+        self.thread.start()
+
+    def start_session(self, name, receiver):
+        with self.lock:
+            self.active[name] = receiver
+
+    def end_session(self, name, receiver):
+        with self.lock:
+            if self.active.get(name) is receiver:
+                del self.active[name]
+            stats = session_stats(receiver)
+            totals = self.totals.setdefault(name, dict.fromkeys(TOTALS, 0))
+            for key in TOTALS:
+                totals[key] += stats[key]
+            for key in ('read_max_bytes', 'rotation_max_seconds', 'writer_queue_max_depth'):
+                totals[key] = max(totals.get(key, 0), stats[key])
+            totals['baud'] = stats['baud']
+            totals['status'] = stats['status']
+
+    def snapshot(self):
+        """ Takes a sample of every device
+
+            :returns:
+                {'time': ..., 'uptime': ..., 'devices': {name: {metric: value}}}
+        """
+        now = time.monotonic()
+        devices = {}
+        with self.lock:
+            names = set(self.totals) | set(self.active)
+            for name in sorted(names):
+                device = dict(self.totals.get(name, {}))
+                receiver = self.active.get(name)
+                if receiver:
+                    stats = session_stats(receiver)
+                    for key, value in stats.items():
+                        if key in TOTALS:
+                            device[key] = device.get(key, 0) + value
+                        elif key in ('read_max_bytes', 'rotation_max_seconds', 'writer_queue_max_depth'):
+                            device[key] = max(device.get(key, 0), value)
+                        else:
+                            device[key] = value
+                device['active'] = 1 if receiver else 0
+
+                then, bytesThen, recordsThen = self.previous.get(name, (now, 0, 0))
+                elapsed = now - then
+                device['bytes_per_second'] = (device['bytes_received_total'] - bytesThen) / elapsed if elapsed else 0.0
+                device['records_per_second'] = (device['records_received_total'] - recordsThen) / elapsed if elapsed else 0.0
+                self.previous[name] = (now, device['bytes_received_total'], device['records_received_total'])
+                devices[name] = device
+        return {'time': time.time(), 'uptime': time.time() - self.started, 'devices': devices}
+
+    def prometheus(self):
+        """ The latest sample in the Prometheus text exposition format """
+        devices = self.latest.get('devices', {})
+        lines = []
+        for name, kind, text in METRICS:
+            lines.append(f"# HELP mgrue_{name} {text}")
+            lines.append(f"# TYPE mgrue_{name} {kind}")
+            for device, values in devices.items():
+                if name in values:
+                    lines.append(f'mgrue_{name}{{device="{device}"}} {values[name]}')
+        return "\n".join(lines) + "\n"
+
+    def run(self):
+        nextLine = time.monotonic() + self.statsInterval
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            self.latest = self.snapshot()
+            if self.statsFile and time.monotonic() >= nextLine:
+                nextLine = time.monotonic() + self.statsInterval
+                try:
+                    with open(self.statsFile, "a") as f:
+                        f.write(json.dumps(self.latest) + "\n")
+                except OSError as e:
+                    logging.warning(f"Could not write stats file {self.statsFile}: {e}")
+
+    def serve(self, port, host="127.0.0.1"):
+        """ Serves the latest sample at /metrics (Prometheus) and /stats.json on a thread of its own """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, kind = registry.prometheus().encode(), "text/plain; version=0.0.4"
+                elif self.path in ("/", "/stats.json"):
+                    body, kind = json.dumps(registry.latest).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="mgrue-metrics-http", daemon=True).start()
+        logging.info(f"Metrics at http://{host}:{self.server.server_address[1]}/metrics")
@@ -0,0 +1,166 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+
+import workers
+
+
+SUFFIX      = "_qc.json"    # <HH-MM-SS>_qc.json, next to the session's .fn files
+
+
+def n50(lengths):
+    """ The length at which reads of that length or longer hold half the bases
+
+        :param lengths:
+            {read length: number of reads}
+    """
+    half = sum(length * count for length, count in lengths.items()) / 2
+    total = 0
+    for length in sorted(lengths, reverse=True):
+        total += length * lengths[length]
+        if total >= half:
+            return length
+    return 0
+
+
+def file_stats(path):
+    """ Works out the QC figures of one closed .fn file
+
+        Runs in a worker process. The sequences are joined and counted with
+        bytes methods, which run over the whole file in C rather than base
+        by base in Python.
+
+        :returns:
+            A dict of the file's name, records, bases, G+C and N counts and
+            {read length: number of reads}
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    lines = data.split(b'\n')
+    sequences = [line.rstrip(b'\r') for line in lines[1:len(lines) - 1:3]]
+    lengths = collections.Counter(map(len, sequences))
+    joined = b''.join(sequences)
+    return {
+        'file':     os.path.basename(path),
+        'records':  len(sequences),
+        'bases':    len(joined),
+        'gc':       len(joined) - len(joined.translate(None, b'GCgc')),
+        'n':        joined.count(b'N') + joined.count(b'n'),
+        'lengths':  dict(lengths),
+    }
+
+
+class Summary:
+    """ Running QC summary of one session's files, kept in <HH-MM-SS>_qc.json
+
+        Files are handed over once they are closed and their figures worked
+        out in the worker pool; each result is merged in as it arrives and
+        the JSON file rewritten, so it is always current for the files
+        finished so far. A resumed session carries on with the summary it
+        left.
+    """
+
+    def __init__(self, destination, curTime):
+        self.path       = os.path.join(destination, curTime + SUFFIX)
+        self.lock       = threading.Lock()
+        self.merged     = threading.Condition(self.lock)
+        self.submitted  = 0
+        self.done       = 0
+        self.files      = []
+        self.lengths    = collections.Counter()
+        self.records    = 0
+        self.bases      = 0
+        self.gc         = 0
+        self.n          = 0
+        if os.path.exists(self.path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                report = json.load(f)
+            for stats in report['files']:
+                self.add(dict(stats, lengths={int(k): v for k, v in stats['lengths'].items()}))
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"QC: ignoring unreadable {self.path}: {e}")
+
+    def submit(self, path):
+        """ Queues the closed file at path """
+        self.watch(workers.get_pool().submit(file_stats, path))
+
+    def watch(self, future, pick=lambda result: result):
+        """ Merges the stats pick() finds in the future's result once it is done """
+        with self.lock:
+            self.submitted += 1
+        future.add_done_callback(lambda f: self.merge(f, pick))
+
+    def merge(self, future, pick):
+        with self.lock:
+            try:
+                self.add(pick(future.result()))
+                self.save()
+            except Exception as e:
+                logging.error(f"QC: {e}")
+            self.done += 1
+            self.merged.notify_all()
+
+    def add(self, stats):
+        self.files.append(stats)
+        self.files.sort(key=lambda s: s['file'])
+        self.lengths.update(stats['lengths'])
+        self.records += stats['records']
+        self.bases += stats['bases']
+        self.gc += stats['gc']
+        self.n += stats['n']
+
+    def report(self):
+        files = [dict(s, gc_fraction=s['gc'] / max(s['bases'], 1), n_fraction=s['n'] / max(s['bases'], 1),
+                      n50=n50(s['lengths'])) for s in self.files]
+        return {
+            'files':        files,
+            'records':      self.records,
+            'bases':        self.bases,
+            'gc_fraction':  self.gc / max(self.bases, 1),
+            'n_fraction':   self.n / max(self.bases, 1),
+            'mean_length':  self.bases / max(self.records, 1),
+            'min_length':   min(self.lengths, default=0),
+            'max_length':   max(self.lengths, default=0),
+            'n50':          n50(self.lengths),
+            'lengths':      dict(sorted(self.lengths.items())),
+        }
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def wait(self):
+        """ Waits for the files handed over so far, then logs the totals """
+        with self.lock:
+            self.merged.wait_for(lambda: self.done == self.submitted)
+        if self.files:
+            logging.info(f"QC: {self.records} reads, {self.bases} bases, N50 {n50(self.lengths)}, "
+                         f"GC {self.gc / max(self.bases, 1):.1%}, N {self.n / max(self.bases, 1):.2%} "
+                         f"in {len(self.files)} files, see {self.path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mGRUE-qc', description='Print the QC figures of .fn files')
+    parser.add_argument('files',
+                        nargs='+',
+                        help='the .fn files')
+    args = parser.parse_args()
+
+    for name in args.files:
+        try:
+            stats = file_stats(name)
+        except OSError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        bases = max(stats['bases'], 1)
+        print(f"{name}: {stats['records']} reads, {stats['bases']} bases, N50 {n50(stats['lengths'])}, "
+              f"GC {stats['gc'] / bases:.1%}, N {stats['n'] / bases:.2%}")
@@ -0,0 +1,375 @@
+import logging
+import os
+import select
+from datetime import datetime
+
+import serial
+
+import baudrate
+import binframe
+import checkpoint
+import flowcontrol
+import serialtrace
+import writer
+
+
+# Transfer states, in order; the receive loop only ever compares these
+CONNECTED, IN_PROGRESS, PAUSED, DONE, KILLED = range(5)
+
+# Status messages shared by the CLI and the GUI
+STATUS_CONNECTED    = "Device Connected"
+STATUS_IN_PROGRESS  = "Data transfer in progress...."
+STATUS_PAUSED       = "Paused."
+STATUS_DONE         = "Data transfer complete! Awaiting new action..."
+STATUS_KILLED       = "Transfer was stopped early. Awaiting new command..."
+STATUS_MESSAGES     = [STATUS_CONNECTED, STATUS_IN_PROGRESS, STATUS_PAUSED, STATUS_DONE, STATUS_KILLED]
+
+BUFFER_SIZE         = 1 << 20       # initial size of the receive buffer, grows if a single line won't fit
+CONTROL_WORDS       = (b'done', b'pause', b'kill')
+NEGOTIATION_WORDS   = (b'ok ', b'no ')      # replies to a baud proposal, only count at the start of a line
+
+
+def read_command(ser):
+    """ Waits for a single '\\n' terminated command from the device
+
+        :returns:
+            The command with the trailing newline removed, or '' if the
+            port timeout expired first
+    """
+    return ser.readline().decode("utf-8", errors='replace')[:-1]
+
+
+def read_into(ser, view):
+    """ Reads whatever the port has available into view
+
+        Blocks until at least one byte arrives or the port timeout expires.
+        On POSIX the bytes go straight from the fd into view, elsewhere this
+        falls back to pyserial's readinto.
+
+        :returns:
+            The number of bytes read, 0 on timeout
+    """
+    if hasattr(os, 'readv') and getattr(ser, 'fd', None) is not None:
+        ready, _, _ = select.select([ser.fd], [], [], ser.timeout)
+        if not ready:
+            return 0
+        try:
+            n = os.readv(ser.fd, [view])
+        except BlockingIOError:
+            return 0
+        if n == 0:
+            raise serial.SerialException('device reports readiness to read but returned no data '
+                                         '(device disconnected or multiple access on port?)')
+        return n
+    return ser.readinto(view[:min(len(view), ser.in_waiting or 1)])
+
+
+class Receiver:
+    """ Receives one data transfer from the mGRUE and writes it to disk
+
+        Records are written to <destination>/<HH-MM-SS>_file<N>.fn, starting a
+        new file every recordsPerFile records. State changes are reported
+        through the status callback with the STATUS_* messages above; the
+        callback is only called when the state changes, never per read.
+
+        Incoming data is read into a reusable buffer and never decoded: line
+        boundaries are found on bytes, and every run of complete lines is
+        handed to a writer.Writer in one piece, which does the disk work on
+        its own thread so a slow disk doesn't hold up reading the port.
+        Reads block on the port (up to its timeout) until at least one byte
+        is available, so an idle link costs no CPU.
+
+        With binary set the device is asked for binframe frames instead of
+        text; they are decoded back into the same text before writing.
+
+        With resume set a checkpoint.Checkpoint is kept in destination while
+        the transfer runs and removed once it is done. If one is already
+        there, the device is asked to carry on after its last record
+        ('handshake resume <records>') and the output continues in the same
+        file set, so a transfer cut short by kill, an unplugged cable or a
+        crash doesn't have to start again from the first record.
+
+        With index set each output file gets a recordindex sidecar, and with
+        compress set to one of compression.FORMATS finished files are
+        compressed. With qc set their QC figures are kept in a running
+        <HH-MM-SS>_qc.json summary, see qc.py. A file a resumable transfer
+        may continue in is left as it is until the transfer is done.
+
+        Given a metrics.Registry the transfer is reported to it under name,
+        by default the port's name.
+
+        Records are also streamed to any sinks given, as they arrive; with
+        files False they go only there.
+
+        Given a trace folder every read is recorded, with its time, to
+        <trace>/<HH-MM-SS>_<name>.mgtrace for replaying later, see
+        serialtrace.py.
+    """
+
+    def __init__(self, ser, destination, recordsPerFile, status=None, bufferSize=BUFFER_SIZE,
+                 queueSize=writer.QUEUE_SIZE, flowControl='none', negotiateBaud=False, maxBaud=None,
+                 binary=False, resume=False, index=False, compress='none', metrics=None, name=None,
+                 sinks=None, files=True, qc=False, trace=None):
+        self.ser            = ser
+        self.recordsPerFile = recordsPerFile
+        self.status         = status or (lambda msg: None)
+        self.state          = None
+        self.currentStatus  = ""
+
+        self.destination    = destination
+        curTime             = datetime.now().strftime("%H-%M-%S")
+        self.checkpoint     = None
+        self.resumed        = None      # the checkpoint this transfer carries on from
+        if resume:
+            self.resumed = checkpoint.load(destination)
+            self.checkpoint = self.resumed or checkpoint.Checkpoint(curTime)
+
+        flow                = flowcontrol.FlowControl(ser, flowControl, high=queueSize * 3 // 4, low=queueSize // 4)
+        self.writer         = writer.Writer(destination, curTime, queueSize, flow, self.checkpoint,
+                                            resume=self.resumed is not None, index=index, compress=compress,
+                                            sinks=sinks, files=files, qc=qc)
+        self.count          = 0         # lines written to the current file
+        if self.resumed:
+            self.count = 3 * self.resumed.fileRecords
+        self.lines          = 0         # lines written this session
+        self.rotateRequested = False    # start a new file at the next record boundary
+        self.bytesRead      = 0
+        self.maxRead        = 0         # largest single read, about the most the port ever had waiting
+        self.metrics        = metrics
+        self.name           = name or os.path.basename(str(getattr(ser, 'port', None) or 'serial'))
+
+        self.buffer         = bytearray(bufferSize)
+        self.view           = memoryview(self.buffer)
+        self.filled         = 0         # bytes of an unfinished line held at the front of the buffer
+
+        self.negotiator     = None
+        self.controlWords   = CONTROL_WORDS
+        if negotiateBaud:
+            self.negotiator = baudrate.Negotiator(ser, maxBaud)
+            self.controlWords = CONTROL_WORDS + NEGOTIATION_WORDS
+
+        self.decoder        = binframe.FrameDecoder() if binary else None
+
+        self.trace          = None
+        if trace:
+            self.trace = serialtrace.TraceWriter(os.path.join(trace, f"{curTime}_{self.name}{serialtrace.SUFFIX}"),
+                                                 port=str(getattr(ser, 'port', None)),
+                                                 baudrate=getattr(ser, 'baudrate', None), binary=binary,
+                                                 negotiateBaud=negotiateBaud, maxBaud=maxBaud)
+
+    def set_state(self, state):
+        self.state = state
+        self.currentStatus = STATUS_MESSAGES[state]
+        self.status(self.currentStatus)
+
+    @property
+    def records(self):
+        return self.lines // 3
+
+    def request_rotate(self):
+        """ Asks for a new file at the next record boundary, from any thread """
+        self.rotateRequested = True
+
+    def finished(self):
+        return self.state is not None and self.state >= DONE
+
+    def finish(self, state):
+        # wait for the writer before reporting, so done means the data is on disk
+        self.writer.close(compressLast=state == DONE or not self.checkpoint)
+        if state == DONE and self.checkpoint:
+            checkpoint.remove(self.destination)
+        self.set_state(state)
+
+    def run(self):
+        """ Acknowledges the device and reads until it sends done or kill
+
+            :returns:
+                The final status message
+        """
+        handshake = b'handshake binary' if self.decoder else b'handshake'
+        if self.resumed:
+            handshake += b' resume %d' % self.resumed.records
+            logging.info(f"Resuming after record {self.resumed.records} "
+                         f"in {self.resumed.file_name(self.destination)}")
+        self.ser.write(handshake + b'\n')
+        self.set_state(CONNECTED)
+        self.writer.start()
+        self.set_state(IN_PROGRESS)
+        if self.metrics:
+            self.metrics.start_session(self.name, self)
+
+        try:
+            while self.state < DONE:
+                if self.filled == len(self.buffer):
+                    self.grow()
+                n = read_into(self.ser, self.view[self.filled:])
+                if self.negotiator:
+                    self.negotiator.check_timeout()
+                    if n and not self.negotiator.verifying and not self.decoder:
+                        self.negotiator.count_errors(self.buffer[self.filled:self.filled + n])
+                if not n:
+                    continue
+                if self.trace:
+                    self.trace.record(self.view[self.filled:self.filled + n])
+                self.bytesRead += n
+                if n > self.maxRead:
+                    self.maxRead = n
+                if self.state == PAUSED:
+                    self.set_state(IN_PROGRESS)
+                if self.decoder:
+                    self.feed_frames(self.filled + n)
+                else:
+                    self.feed(self.filled + n)
+        finally:
+            try:
+                self.writer.close(compressLast=not self.checkpoint)     # raises if the writer failed
+            finally:
+                if self.negotiator:
+                    self.negotiator.close()
+                if self.trace:
+                    self.trace.close()
+                if self.decoder:
+                    logging.info(f"Binary framing: {self.decoder.crcErrors} frames failed CRC, "
+                                 f"{self.decoder.skipped} bytes skipped")
+                if self.metrics:
+                    self.metrics.end_session(self.name, self)
+        return self.currentStatus
+
+    def grow(self):
+        self.view.release()
+        self.buffer.extend(bytes(len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+    def feed(self, end):
+        """ Handles every complete line in buffer[:end] and keeps the rest """
+        last = self.buffer.rfind(b'\n', 0, end)
+        if last >= 0:
+            self.process(0, last + 1)
+            if self.finished():
+                return
+            # move the unfinished line to the front, ready for the next read; copied out
+            # first, as a slice assigned from a view of the same buffer may overlap it
+            self.buffer[:end - last - 1] = bytes(self.view[last + 1:end])
+            end -= last + 1
+        self.filled = end
+
+        if self.buffer.find(b'done', 0, end) >= 0:     # the device doesn't always terminate the final done
+            self.finish(DONE)
+
+    def feed_frames(self, end):
+        """ Handles every complete frame in buffer[:end] and keeps the rest """
+        skipped = self.decoder.skipped
+        used, events = self.decoder.decode(self.buffer, self.view, end)
+        if self.negotiator and not self.negotiator.verifying:
+            self.negotiator.add_errors(end - self.filled, self.decoder.skipped - skipped)
+
+        for kind, data in events:
+            if self.negotiator and self.negotiator.verifying:
+                if data == b'sync':
+                    self.negotiator.on_sync()
+            elif kind == 'text':
+                self.write_lines(data, 0, len(data))
+            else:
+                word = next((w for w in CONTROL_WORDS + NEGOTIATION_WORDS if data.startswith(w)), None)
+                if word:
+                    self.control(word, data)
+                if self.finished():
+                    return
+
+        self.buffer[:end - used] = bytes(self.view[used:end])      # at most one partial frame, see feed()
+        self.filled = end - used
+
+    def process(self, start, stop):
+        """ Writes the complete lines in buffer[start:stop], acting on any control lines """
+        while start < stop:
+            if self.negotiator and self.negotiator.verifying:
+                start = self.skip_to_sync(start, stop)
+                continue
+            lineStart, lineEnd, word = self.find_control(start, stop)
+            self.write_lines(self.buffer, start, lineStart)
+            if word is None:
+                return
+            self.control(word, bytes(self.buffer[lineStart:lineEnd]))
+            if self.finished():
+                return
+            start = lineEnd
+
+    def control(self, word, line):
+        """ Acts on a control line from the device, word being the control word it contains """
+        if word == b'done':
+            self.finish(DONE)
+        elif word == b'pause':          # Pauses the transfer for a baud rate change
+            self.set_state(PAUSED)
+            if self.negotiator:
+                self.negotiator.on_pause()
+        elif word == b'kill':
+            self.finish(KILLED)
+        elif word in NEGOTIATION_WORDS and self.negotiator:
+            self.negotiator.on_reply(word, line)
+
+    def skip_to_sync(self, start, stop):
+        """ Drops lines until the device's sync at a new baud rate
+
+            :returns:
+                Where processing should carry on
+        """
+        i = self.buffer.find(b'sync\n', start, stop)
+        if i < 0:
+            return stop
+        self.negotiator.on_sync()
+        return i + 5
+
+    def find_control(self, start, stop):
+        """ Finds the first line in buffer[start:stop] containing a control word
+
+            :returns:
+                (lineStart, lineEnd, word), or (stop, stop, None) if there is none
+        """
+        found, word = stop, None
+        for control in self.controlWords:
+            i = self.buffer.find(control, start, found)
+            if control in NEGOTIATION_WORDS:
+                while i > start and self.buffer[i - 1] != ord('\n'):
+                    i = self.buffer.find(control, i + 1, found)
+            if i >= 0:
+                found, word = i, control
+        if word is None:
+            return stop, stop, None
+        lineStart = self.buffer.rfind(b'\n', start, found) + 1 or start
+        lineEnd = self.buffer.find(b'\n', found, stop) + 1 or stop
+        return lineStart, lineEnd, word
+
+    def write_lines(self, data, start, stop):
+        """ Writes the complete lines in data[start:stop], rotating files as needed """
+        while start < stop:
+            lines = data.count(b'\n', start, stop)
+            remaining = max(3 * self.recordsPerFile - self.count, 0)     # a resumed file may already be full
+            if self.rotateRequested:
+                if self.count:
+                    remaining = min(remaining, -self.count % 3)
+                else:
+                    self.rotateRequested = False    # the file is new already
+            if lines < remaining:
+                self.writer.write(data[start:stop], lines)
+                self.count += lines
+                self.lines += lines
+                return
+            split = self.nth_line_end(data, start, stop, remaining, lines)
+            self.writer.write(data[start:split], remaining)
+            self.writer.rotate()
+            self.rotateRequested = False
+            self.count = 0
+            self.lines += remaining
+            start = split
+
+    def nth_line_end(self, data, start, stop, n, lines):
+        """ Returns the offset just past the nth newline of the lines in data[start:stop] """
+        if n <= lines - n:
+            pos = start
+            for _ in range(n):
+                pos = data.find(b'\n', pos, stop) + 1
+            return pos
+        pos = stop
+        for _ in range(lines - n):
+            pos = data.rfind(b'\n', start, pos - 1) + 1
+        return pos
@@ -0,0 +1,176 @@
+import argparse
+import collections
+import mmap
+import os
+import struct
+import sys
+
+import compression
+
+
+# An index sits next to each output file as <file>.fn.idx:
+#
+#   magic       4s      b'FNIX'
+#   version     u16
+#   entry size  u16
+#
+# followed by one fixed size entry per complete record, in file order:
+#
+#   ordinal     u64     record number counted from the first record of the transfer
+#   offset      u64     where the record's '>' header line starts in the .fn file
+#   header      u32     length of the header line, without its line ending
+#   sequence    u32     length of the sequence line, without its line ending
+#
+# Integers are little endian. Entry i is at a fixed position, so looking a
+# record up or counting them needs no scan of either file.
+
+MAGIC       = b'FNIX'
+VERSION     = 1
+HEADER      = struct.Struct('<4sHH')
+ENTRY       = struct.Struct('<QQII')
+SUFFIX      = ".idx"
+
+Entry = collections.namedtuple('Entry', 'ordinal offset headerLength sequenceLength')
+
+
+class IndexWriter:
+    """ Builds the index of one output file as its lines are written
+
+        add() is given the same '\\n' terminated lines the writer writes,
+        before they are translated to '\\r\\n', and works out the offsets the
+        records end up at in the file. Records are 3 lines, as the receiver
+        counts them; an entry is added once a record's blank line arrives.
+    """
+
+    def __init__(self, path, ordinal=0, offset=0, records=0, resume=False):
+        if resume:
+            # carry on after the records the checkpoint kept, dropping any entries past them
+            self.file = open(path, "r+b")
+            self.file.truncate(HEADER.size + records * ENTRY.size)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            self.file.write(HEADER.pack(MAGIC, VERSION, ENTRY.size))
+        self.ordinal        = ordinal + records     # ordinal of the next record
+        self.offset         = offset                # where the next line starts in the .fn file
+        self.line           = 0                     # which line of a record the next line is
+        self.start          = 0
+        self.headerLength   = 0
+        self.sequenceLength = 0
+
+    def add(self, data):
+        entries = bytearray()
+        for line in data.split(b'\n')[:-1]:
+            if self.line == 0:
+                self.start = self.offset
+                self.headerLength = len(line)
+            elif self.line == 1:
+                self.sequenceLength = len(line)
+            else:
+                entries += ENTRY.pack(self.ordinal, self.start, self.headerLength, self.sequenceLength)
+                self.ordinal += 1
+            self.line = (self.line + 1) % 3
+            self.offset += len(line) + 2        # the writer ends lines with '\r\n'
+        self.file.write(entries)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def index_path(path):
+    return path if path.endswith(SUFFIX) else path + SUFFIX
+
+
+def count_records(path):
+    """ Number of complete records in the .fn file at path (or its index), from the index's size alone """
+    return (os.path.getsize(index_path(path)) - HEADER.size) // ENTRY.size
+
+
+class RecordIndex:
+    """ Random access to the records of a captured .fn file through its index
+
+        with RecordIndex("output/12-00-00_file0.fn") as index:
+            len(index)          # records in the file
+            index[10]           # Entry of the 11th record
+            index.read(10)      # (header, sequence) of the 11th record
+
+        The index keeps working once its file has been compressed, but then
+        read() has to decompress up to the record it is after.
+    """
+
+    def __init__(self, path):
+        self.path       = index_path(path)
+        self.dataPath   = self.path[:-len(SUFFIX)]
+        self.file       = open(self.path, "rb")
+        self.map        = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data       = None
+
+        magic, version, entrySize = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or entrySize != ENTRY.size:
+            self.close()
+            raise ValueError(f"{self.path} is not a version {VERSION} record index")
+
+    def __len__(self):
+        return (len(self.map) - HEADER.size) // ENTRY.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("record index out of range")
+        return Entry._make(ENTRY.unpack_from(self.map, HEADER.size + i * ENTRY.size))
+
+    def __iter__(self):
+        for fields in ENTRY.iter_unpack(self.map[HEADER.size:HEADER.size + len(self) * ENTRY.size]):
+            yield Entry._make(fields)
+
+    def read(self, i):
+        """ Reads record i from the .fn file
+
+            :returns:
+                (header, sequence), both without line endings
+        """
+        entry = self[i]
+        if self.data is None:
+            self.data = compression.open_compressed(self.dataPath)
+        self.data.seek(entry.offset)
+        raw = self.data.read(entry.headerLength + 2 + entry.sequenceLength)
+        sequenceAt = entry.headerLength + (2 if raw[entry.headerLength:entry.headerLength + 1] == b'\r' else 1)
+        return raw[:entry.headerLength], raw[sequenceAt:sequenceAt + entry.sequenceLength]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        if self.data:
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mGRUE-index', description='Look up records in captured .fn files through their index')
+    parser.add_argument('files',
+                        nargs='+',
+                        help='.fn files (or their .idx files)')
+    parser.add_argument('-r',
+                        '--record',
+                        type=int,
+                        action='append',
+                        help='print this record of each file, counting from 0. Default print the record count.')
+    args = parser.parse_args()
+
+    for path in args.files:
+        if not args.record:
+            print(f"{path}: {count_records(path)} records")
+            continue
+        with RecordIndex(path) as index:
+            for i in args.record:
+                header, sequence = index.read(i)
+                sys.stdout.buffer.write(header + b'\n' + sequence + b'\n\n')
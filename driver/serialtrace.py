@@ -0,0 +1,264 @@
+import argparse
+import cProfile
+import json
+import logging
+import os
+import pstats
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import serial
+
+
+# A trace holds the bytes a receiver read from the port, one entry per read,
+# so the chunk boundaries the parser saw are kept:
+#
+#   magic       8s      b'MGTRACE1'
+#   info size   u32
+#   info        JSON    port, baud rate and receiver options of the session
+#
+# followed by one entry per read:
+#
+#   time        f64     seconds since the trace was started
+#   size        u32     bytes read
+#   data        size bytes
+#
+# Integers and floats are little endian. The host's own writes (handshake,
+# flow control, baud proposals) are not recorded; a replay only needs what
+# the device sent.
+
+MAGIC       = b'MGTRACE1'
+HEADER      = struct.Struct('<8sI')
+ENTRY       = struct.Struct('<dI')
+SUFFIX      = ".mgtrace"
+WRITE_SIZE  = 1 << 20       # buffering of the trace file, reads are small
+QUEUE_SIZE  = 4096          # reads the trace thread may fall behind by before the reader waits
+
+CLOSE       = object()      # queue marker: stop the trace thread
+
+
+class TraceWriter:
+    """ Records every read of a receive session to a trace file
+
+        record() only timestamps and copies the read; the file is written on
+        a thread of its own, so the reader's timing stays what it would be
+        without a trace. close() waits for everything recorded to reach the
+        file.
+    """
+
+    def __init__(self, path, **info):
+        self.path   = path
+        self.file   = open(path, "wb", buffering=WRITE_SIZE)
+        self.reads  = 0
+        self.bytes  = 0
+        self.error  = None
+        info = dict(info, started=datetime.now().isoformat(timespec='seconds'))
+        data = json.dumps(info).encode()
+        self.file.write(HEADER.pack(MAGIC, len(data)) + data)
+        self.queue  = queue.Queue(QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, name="mgrue-trace", daemon=True)
+        self.thread.start()
+        self.start  = time.monotonic()
+
+    def record(self, data):
+        self.queue.put((time.monotonic() - self.start, bytes(data)))
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is CLOSE:
+                    break
+                seconds, data = item
+                self.file.write(ENTRY.pack(seconds, len(data)))
+                self.file.write(data)
+                self.reads += 1
+                self.bytes += len(data)
+        except OSError as e:
+            self.error = e
+            # keep draining so the reader never blocks on a trace that has died
+            while self.queue.get() is not CLOSE:
+                pass
+        finally:
+            self.file.close()
+
+    def close(self):
+        self.queue.put(CLOSE)
+        self.thread.join()
+        if self.error:
+            logging.error(f"Trace: writing {self.path} failed after {self.reads} reads: {self.error}")
+        else:
+            logging.info(f"Trace: {self.reads} reads, {self.bytes} bytes in {self.path}")
+
+
+def read_info(f):
+    """ Reads the header of the trace open in f
+
+        :returns:
+            The session info dict
+    """
+    magic, size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', 'file')} is not an mGRUE trace")
+    return json.loads(f.read(size))
+
+
+def reads(f):
+    """ Yields (seconds, data) for every read in the trace open in f, after read_info() """
+    while True:
+        entry = f.read(ENTRY.size)
+        if len(entry) < ENTRY.size:
+            return
+        seconds, size = ENTRY.unpack(entry)
+        data = f.read(size)
+        if len(data) < size:
+            return      # cut short, e.g. by a crash while recording
+        yield seconds, data
+
+
+class ReplayPort:
+    """ Stands in for the serial port, giving back a trace's reads
+
+        Each read hands over exactly one recorded chunk (or what is left of
+        it, if the receiver's buffer is smaller), so the receiver sees the
+        same chunk boundaries as during the capture. With realtime set every
+        chunk waits for its recorded time, otherwise they follow each other
+        as fast as the receiver takes them. Writes are counted and dropped.
+        When the trace runs out a read raises serial.SerialException, as an
+        unplugged device would.
+    """
+
+    def __init__(self, path, realtime=False):
+        self.file       = open(path, "rb")
+        self.info       = read_info(self.file)
+        self.entries    = reads(self.file)
+        self.realtime   = realtime
+        self.port       = self.info.get('port') or os.path.basename(path)
+        self.baudrate   = self.info.get('baudrate', 921600)
+        self.timeout    = 1
+        self.fd         = None      # makes receiver.read_into use readinto()
+        self.pending    = memoryview(b'')
+        self.written    = 0
+        self.start      = None
+
+    def next_chunk(self):
+        try:
+            seconds, data = next(self.entries)
+        except StopIteration:
+            raise serial.SerialException("end of trace") from None
+        if self.start is None:
+            self.start = time.monotonic() - seconds
+        if self.realtime:
+            wait = self.start + seconds - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.pending = memoryview(data)
+
+    @property
+    def in_waiting(self):
+        if not self.pending:
+            self.next_chunk()
+        return len(self.pending)
+
+    def readinto(self, view):
+        if not self.pending:
+            self.next_chunk()
+        n = min(len(view), len(self.pending))
+        view[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+def replay(path, destination, recordsPerFile, realtime=False, **options):
+    """ Feeds the trace at path through a receiver.Receiver writing to destination
+
+        The receiver gets the options the trace was recorded with, overridden
+        by any given.
+
+        :returns:
+            (the Receiver, seconds taken)
+    """
+    import receiver
+
+    port = ReplayPort(path, realtime)
+    settings = {k: port.info[k] for k in ('binary', 'negotiateBaud', 'maxBaud') if k in port.info}
+    settings.update(options)
+    current = receiver.Receiver(port, destination, recordsPerFile, **settings)
+    start = time.monotonic()
+    try:
+        current.run()
+    except serial.SerialException as e:
+        logging.warning(f"Replay ended before the device finished: {e}")
+    finally:
+        port.close()
+    return current, time.monotonic() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mGRUE-replay', description='Replay a recorded serial trace through the receiver')
+    parser.add_argument('trace',
+                        help='trace file recorded with --trace')
+    parser.add_argument('-l',
+                        '--location',
+                        help='destination for the replayed records. Default a temporary folder, removed afterwards.')
+    parser.add_argument('-r',
+                        '--records',
+                        type=int,
+                        default=4000,
+                        help='the number of records per file. Default 4000.')
+    parser.add_argument('--realtime',
+                        action='store_true',
+                        help='deliver each read at its recorded time instead of as fast as possible')
+    parser.add_argument('--profile',
+                        metavar='PATH',
+                        help='profile the replay with cProfile, save the stats to PATH and print the top functions')
+    parser.add_argument('--tracemalloc',
+                        action='store_true',
+                        help='trace memory allocations during the replay and print the peak and top allocation sites')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    with tempfile.TemporaryDirectory() as scratch:
+        destination = args.location or scratch
+        profiler = cProfile.Profile() if args.profile else None
+        if args.tracemalloc:
+            tracemalloc.start()
+        if profiler:
+            profiler.enable()
+        try:
+            current, seconds = replay(args.trace, destination, args.records, args.realtime)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        finally:
+            if profiler:
+                profiler.disable()
+
+        print(f"{current.bytesRead} bytes, {current.records} records in {seconds:.3f}s "
+              f"({current.bytesRead / max(seconds, 1e-9) / 1e6:.2f} MB/s): {current.currentStatus}")
+        if args.tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"Peak traced memory {peak / 1e6:.2f} MB, top allocation sites:")
+            for stat in snapshot.statistics('lineno')[:10]:
+                print(f"  {stat}")
+        if profiler:
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
@@ -0,0 +1,223 @@
+import errno
+import logging
+import os
+import queue
+import socket
+import stat
+import sys
+import threading
+import time
+
+
+POLICIES    = ['block', 'drop']
+QUEUE_SIZE  = 256           # chunks a consumer may fall behind by before the policy applies
+DRAIN_TIME  = 30            # seconds close() gives a reader to take the chunks still queued
+
+CLOSE       = object()      # queue marker: stop the consumer's thread
+
+
+class Consumer:
+    """ Feeds one downstream reader on a thread of its own
+
+        Chunks wait in a bounded queue. When it is full, 'block' makes the
+        writer wait for the reader, which eventually holds the device off
+        through the writer queue and flow control, and 'drop' throws the
+        chunk away for this reader only. Chunks are whole records, so a
+        reader that misses some still sees well formed .fn text.
+    """
+
+    def __init__(self, name, send, queueSize=QUEUE_SIZE, policy='block', done=None):
+        self.name           = name
+        self.send           = send
+        self.policy         = policy
+        self.done           = done      # called once the reader has gone
+        self.queue          = queue.Queue(queueSize)
+        self.alive          = True
+        self.dropped        = 0         # chunks thrown away under the drop policy
+        self.droppedBytes   = 0
+        self.thread         = threading.Thread(target=self.run, name="mgrue-sink-" + name, daemon=True)
+        self.thread.start()
+
+    def offer(self, chunk):
+        if not self.alive:
+            return
+        if self.policy == 'block':
+            self.queue.put(chunk)
+            return
+        try:
+            self.queue.put_nowait(chunk)
+        except queue.Full:
+            self.dropped += 1
+            self.droppedBytes += len(chunk)
+
+    def close(self, timeout=DRAIN_TIME):
+        """ Lets the reader take the chunks still queued, then stops the thread """
+        deadline = time.monotonic() + timeout
+        try:
+            if self.alive:
+                self.queue.put(CLOSE, timeout=timeout)
+            self.thread.join(max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+        if self.thread.is_alive():
+            logging.warning(f"Sink {self.name}: reader still {self.queue.qsize()} chunks behind, giving up on it")
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is CLOSE:
+                    break
+                self.send(chunk)
+        except OSError as e:
+            logging.info(f"Sink {self.name}: reader gone ({e})")
+            self.alive = False
+            # keep draining so a blocked writer is let go
+            while self.queue.get() is not CLOSE:
+                pass
+        finally:
+            self.alive = False
+            if self.dropped:
+                logging.info(f"Sink {self.name}: dropped {self.dropped} chunks, {self.droppedBytes} bytes")
+            if self.done:
+                self.done(self)
+
+
+class StreamSink:
+    """ Writes records to a binary stream, e.g. stdout """
+
+    def __init__(self, stream, name="stdout", queueSize=QUEUE_SIZE, policy='block'):
+        self.stream     = stream
+        self.consumer   = Consumer(name, self.send, queueSize, policy)
+
+    def send(self, chunk):
+        self.stream.write(chunk)
+        self.stream.flush()
+
+    def write(self, chunk):
+        self.consumer.offer(chunk)
+
+    def close(self):
+        self.consumer.close()
+
+
+class FifoSink:
+    """ Writes records to a named pipe, creating it if needed
+
+        The pipe is opened without waiting: records that arrive while
+        nobody has it open for reading are dropped, whatever the policy, so
+        a pipe without a reader never holds up the capture. If the reader
+        goes away the records in hand are lost and the pipe is opened again
+        for the next one.
+    """
+
+    def __init__(self, path, queueSize=QUEUE_SIZE, policy='block'):
+        self.path = path
+        if not os.path.exists(path):
+            os.mkfifo(path, 0o600)
+        elif not stat.S_ISFIFO(os.stat(path).st_mode):
+            raise OSError(f"{path} exists and is not a named pipe")
+        self.fd         = None
+        self.consumer   = Consumer("fifo:" + path, self.send, queueSize, policy, done=self.finished)
+
+    def send(self, chunk):
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:      # anything but 'no reader yet'
+                    raise
+                self.consumer.dropped += 1
+                self.consumer.droppedBytes += len(chunk)
+                return
+            os.set_blocking(self.fd, True)      # only this sink's thread waits on a slow reader
+        try:
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(self.fd, view):]
+        except BrokenPipeError:
+            os.close(self.fd)
+            self.fd = None
+
+    def finished(self, consumer):
+        if self.fd is not None:
+            os.close(self.fd)       # the reader sees end of file
+            self.fd = None
+
+    def write(self, chunk):
+        self.consumer.offer(chunk)
+
+    def close(self):
+        self.consumer.close()
+
+
+class SocketSink:
+    """ Serves records on a Unix domain socket to any number of subscribers
+
+        Each subscriber gets the records written after it connects, through
+        a Consumer of its own, so one slow subscriber under the drop policy
+        doesn't hold up the others.
+    """
+
+    def __init__(self, path, queueSize=QUEUE_SIZE, policy='block'):
+        self.path       = path
+        self.queueSize  = queueSize
+        self.policy     = policy
+        self.consumers  = []
+        self.lock       = threading.Lock()
+        self.count      = 0
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0o600)
+        self.server.listen()
+        threading.Thread(target=self.accept, name="mgrue-sink-accept", daemon=True).start()
+        logging.info(f"Serving records on {path}")
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:         # closed
+                return
+            conn.shutdown(socket.SHUT_RD)
+            with self.lock:
+                self.count += 1
+                consumer = Consumer(f"socket:{self.path}#{self.count}", conn.sendall, self.queueSize, self.policy,
+                                    done=lambda c, conn=conn: self.remove(c, conn))
+                self.consumers.append(consumer)
+
+    def remove(self, consumer, conn):
+        conn.close()
+        with self.lock:
+            if consumer in self.consumers:
+                self.consumers.remove(consumer)
+
+    def write(self, chunk):
+        with self.lock:
+            consumers = list(self.consumers)
+        for consumer in consumers:
+            consumer.offer(chunk)
+
+    def close(self):
+        self.server.close()
+        with self.lock:
+            consumers = list(self.consumers)
+        for consumer in consumers:
+            consumer.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_sink(spec, queueSize=QUEUE_SIZE, policy='block'):
+    """ Makes a sink from 'stdout', 'fifo:<path>' or 'socket:<path>' """
+    if spec == 'stdout':
+        return StreamSink(sys.stdout.buffer, queueSize=queueSize, policy=policy)
+    kind, _, path = spec.partition(':')
+    if kind == 'fifo' and path:
+        return FifoSink(path, queueSize, policy)
+    if kind == 'socket' and path:
+        return SocketSink(path, queueSize, policy)
+    raise ValueError(f"unknown sink {spec!r}, expected stdout, fifo:<path> or socket:<path>")
@@ -0,0 +1,209 @@
+import glob
+import gzip
+import lzma
+import os
+import queue
+import re
+import threading
+import time
+
+
+BLOCK_SIZE          = 1 << 16   # bytes read from the file and written to the port at a time
+PROGRESS_INTERVAL   = 1         # seconds between progress reports
+PREFETCH            = 16        # blocks the prefetch thread may read ahead of the port
+SUFFIXES            = ('.fn', '.fn.gz', '.fn.xz')
+
+END                 = object()  # queue marker: every file has been read
+
+
+def natural_key(path):
+    """ Sorts <HH-MM-SS>_file2.fn before <HH-MM-SS>_file10.fn """
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+
+def expand_inputs(spec):
+    """ Turns one -f argument into the files it stands for
+
+        spec may be a file, a directory, whose .fn files are taken, or a
+        glob pattern. .fn.gz (gzip or bgzip) and .fn.xz files are read
+        decompressed.
+
+        :returns:
+            The paths, in natural order
+        :raises ValueError:
+            If spec matches no usable file
+    """
+    if os.path.isdir(spec):
+        paths = [os.path.join(spec, name) for name in os.listdir(spec)]
+    elif glob.has_magic(spec):
+        paths = glob.glob(spec)
+    elif os.path.isfile(spec):
+        if not spec.endswith(SUFFIXES):
+            raise ValueError(f"{spec} is not a valid file type")
+        return [spec]
+    else:
+        raise ValueError(f"{spec} is not a valid file")
+    paths = sorted((p for p in paths if p.endswith(SUFFIXES) and os.path.isfile(p)), key=natural_key)
+    if not paths:
+        raise ValueError(f"{spec} holds no {', '.join(SUFFIXES)} files")
+    return paths
+
+
+def open_input(path):
+    """ Opens path for reading, decompressing .gz and .xz files
+
+        :returns:
+            (the raw file, the stream to read the contents from)
+    """
+    raw = open(path, "rb")
+    if path.endswith(".gz"):
+        return raw, gzip.GzipFile(fileobj=raw, mode="rb")
+    if path.endswith(".xz"):
+        return raw, lzma.LZMAFile(raw, "rb")
+    return raw, raw
+
+
+class Prefetcher:
+    """ Reads the files to upload on a thread of its own
+
+        Blocks are read, decompressed and given '\\n' line endings up to
+        PREFETCH blocks ahead of the port, straight across file boundaries,
+        so the next file is ready by the time the last one is on the wire.
+        Every block comes with how far through its raw file the reader is,
+        for progress reports.
+    """
+
+    def __init__(self, paths, blockSize=BLOCK_SIZE, depth=PREFETCH):
+        self.paths      = paths
+        self.blockSize  = blockSize
+        self.queue      = queue.Queue(depth)
+        self.error      = None
+        self.thread     = threading.Thread(target=self.run, name="mgrue-prefetch", daemon=True)
+        self.thread.start()
+
+    def read_file(self, number, path):
+        raw, stream = open_input(path)
+        with raw, stream:
+            carry = b''     # a '\r' that may start a '\r\n' split across blocks
+            last = b'\n'
+            while True:
+                data = stream.read(self.blockSize)
+                if not data:
+                    break
+                block = carry + data
+                carry = b''
+                if block.endswith(b'\r'):
+                    block, carry = block[:-1], b'\r'
+                if b'\r' in block:
+                    block = block.replace(b'\r\n', b'\n')
+                if block:
+                    last = block[-1:]
+                    self.queue.put((number, block, raw.tell()))
+            if carry or last != b'\n':     # keep the last line of this file off the first line of the next
+                self.queue.put((number, b'\n', raw.tell()))
+
+    def run(self):
+        try:
+            for number, path in enumerate(self.paths):
+                self.read_file(number, path)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(END)
+
+    def __iter__(self):
+        """ Yields (file number, block, bytes of the raw file read so far) """
+        while True:
+            item = self.queue.get()
+            if item is END:
+                break
+            yield item
+        if self.error:
+            raise self.error
+
+
+class Uploader:
+    """ Streams .fn files to the mGRUE for transfer mode
+
+        Reading and decompressing happen on a Prefetcher thread, and each
+        block it hands over goes to the port in a single write, so memory
+        use is bounded no matter how large the files are and the port
+        doesn't sit idle while the next file is opened. Line endings are
+        sent as '\\n' like the device expects, whatever the file was saved
+        with.
+
+        progress(sent, total, rate) is called about every PROGRESS_INTERVAL
+        seconds with bytes of the input files read so far, their total size
+        and bytes/s; compressed files count at their size on disk.
+    """
+
+    def __init__(self, ser, blockSize=BLOCK_SIZE, progress=None):
+        self.ser        = ser
+        self.blockSize  = blockSize
+        self.progress   = progress or (lambda sent, total, rate: None)
+
+        self.files      = 0
+        self.bytesSent  = 0         # bytes written to the port
+        self.starved    = 0.0       # seconds the port waited on the prefetch thread
+        self.seconds    = 0.0
+
+    def upload(self, path):
+        """ Sends the contents of path, without the closing done
+
+            :returns:
+                (bytes sent, seconds taken)
+        """
+        return self.upload_files([path])
+
+    def upload_files(self, paths):
+        """ Sends the contents of every file in paths back to back, without the closing done
+
+            :returns:
+                (bytes sent, seconds taken)
+        """
+        sizes = [os.path.getsize(path) for path in paths]
+        total = sum(sizes)
+        before = 0          # raw bytes in the files already sent
+        current = 0
+        sent = 0
+        start = lastReport = time.monotonic()
+
+        blocks = iter(Prefetcher(paths, self.blockSize))
+        while True:
+            waited = time.monotonic()
+            item = next(blocks, None)
+            self.starved += time.monotonic() - waited
+            if item is None:
+                break
+            number, block, position = item
+            while current < number:
+                before += sizes[current]
+                current += 1
+            self.ser.write(block)
+            sent += len(block)
+
+            now = time.monotonic()
+            if now - lastReport >= PROGRESS_INTERVAL:
+                self.progress(before + position, total, (before + position) / (now - start))
+                lastReport = now
+
+        self.ser.flush()
+        seconds = time.monotonic() - start
+        self.progress(total, total, total / seconds if seconds else 0)
+        self.files += len(paths)
+        self.bytesSent += sent
+        self.seconds += seconds
+        return sent, seconds
+
+    def summary(self):
+        rate = self.bytesSent / self.seconds if self.seconds else 0
+        return (f"Uploaded {self.files} files, {self.bytesSent / 1e6:.1f} MB in {self.seconds:.1f}s "
+                f"at {rate / 1e6:.2f} MB/s, port waited {self.starved:.3f}s on reading")
+
+
+def log_progress(log):
+    """ Builds a progress callback that reports through log, e.g. logging.info """
+    def progress(sent, total, rate):
+        percent = 100 * sent / total if total else 100
+        log(f"Uploaded {sent / 1e6:.1f} of {total / 1e6:.1f} MB ({percent:.0f}%) at {rate / 1e6:.2f} MB/s")
+    return progress
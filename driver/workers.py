@@ -0,0 +1,35 @@
+import atexit
+import concurrent.futures
+import multiprocessing
+import threading
+
+
+pool = None     # shared by every Writer, so several devices don't start a pool each
+lock = threading.Lock()
+
+# Workers are started fresh rather than forked from a process that is busy
+# reading ports on several threads
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def get_pool():
+    """ The process pool finished output files are handed to for compression and QC """
+    global pool
+    with lock:
+        if pool is None:
+            pool = concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context(START_METHOD))
+            atexit.register(shutdown)
+        return pool
+
+
+def shutdown():
+    """ Stops the worker processes, after the files they are working on
+
+        Files still waiting for a worker are left as they are, uncompressed
+        and out of the QC summary.
+    """
+    global pool
+    with lock:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+            pool = None
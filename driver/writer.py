@@ -0,0 +1,285 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import checkpoint
+import compression
+import qc
+import recordindex
+
+
+QUEUE_SIZE  = 64            # chunks the reader may get ahead of the disk before it has to wait
+IDLE_FLUSH  = .5            # seconds without new data before buffered output is flushed
+
+ROTATE      = object()      # queue marker: close the current file and start the next one
+CLOSE       = object()      # queue marker: close the current file and stop
+
+
+class Writer:
+    """ Writes received data to disk on a thread of its own
+
+        The reader hands over chunks of complete lines with write() and marks
+        record-count boundaries with rotate(); everything that touches the
+        disk (opening, writing, '\\r\\n' translation, flushing and rotating
+        the <HH-MM-SS>_file<N>.fn files) happens on the writer thread. The
+        queue between them is bounded, so a disk that can't keep up
+        eventually makes write() wait; that time is counted as stallTime.
+        Given a flowcontrol.FlowControl, the device is asked to stop before
+        that happens.
+
+        Given a checkpoint.Checkpoint, the writer keeps it up to date with
+        the end of the last complete record and saves it every
+        checkpoint.INTERVAL seconds, after flushing the file. With resume set
+        the files are named after the checkpoint and the last one is
+        reopened, cut back to the checkpoint's offset and appended to.
+
+        With index set every file gets a recordindex sidecar, built as the
+        file is written. With compress set to one of compression.FORMATS,
+        each file is handed to a compression.Compressor once it is closed.
+        With qc set each closed file's QC figures are worked out in the
+        worker pool too and merged into the session's qc.Summary.
+
+        Every sink in sinks (see sinks.py) is also given the received
+        records as they arrive, as '\n' terminated .fn text cut at record
+        boundaries. The sinks outlive the writer. With files False nothing
+        is written to disk at all.
+    """
+
+    def __init__(self, destination, curTime, queueSize=QUEUE_SIZE, flow=None, checkpoint=None, resume=False,
+                 index=False, compress='none', sinks=None, files=True, qc=False):
+        self.destination    = destination
+        self.curTime        = curTime
+        self.flow           = flow      # flowcontrol.FlowControl told about the queue depth
+        self.fileCounter    = 0
+        self.file           = None
+        self.checkpoint     = checkpoint
+        self.resume         = resume
+        self.indexed        = index
+        self.index          = None      # recordindex.IndexWriter of the current file
+        self.compressor     = compression.Compressor(compress) if compress != 'none' else None
+        self.checked        = qc and files
+        self.qc             = None      # qc.Summary, made once the session's name is known
+        self.sinks          = sinks or []
+        self.files          = files
+        self.partial        = bytearray()   # lines of a record not yet passed to the sinks
+        self.partialLines   = 0
+        self.savedAt        = 0.0
+        self.dirty          = False     # the checkpoint moved since it was last saved
+        self.fileLines      = 0         # lines in the current file
+        self.fileBytes      = 0
+        self.recordsBefore  = 0         # complete records in the files before the current one
+        self.error          = None
+        self.closed         = False
+
+        self.queue          = queue.Queue(queueSize)
+        self.thread         = threading.Thread(target=self.run, name="mgrue-writer", daemon=True)
+
+        self.maxDepth       = 0         # most chunks waiting in the queue at once
+        self.stallTime      = 0.0       # seconds the reader spent waiting on a full queue
+        self.rotateTime     = 0.0       # seconds spent closing and opening files
+        self.maxRotate      = 0.0       # longest single rotation
+        self.bytesWritten   = 0
+
+    def file_name(self):
+        return self.destination + "/" + self.curTime + "_file" + str(self.fileCounter) + ".fn"
+
+    def open_file(self):
+        if not self.files:
+            return
+        mode = "ab" if os.name == 'nt' else "wb"
+        self.file = open(self.file_name(), mode)
+        if self.indexed:
+            ordinal = self.index.ordinal if self.index else 0
+            self.index = recordindex.IndexWriter(self.file_name() + recordindex.SUFFIX, ordinal)
+
+    def reopen_file(self):
+        cp = self.checkpoint
+        self.curTime = cp.curTime
+        self.fileCounter = cp.fileCounter
+        self.file = open(self.file_name(), "r+b")
+        self.file.truncate(cp.offset)       # drop whatever was written after the last complete record
+        self.file.seek(cp.offset)
+        self.fileLines = 3 * cp.fileRecords
+        self.fileBytes = cp.offset
+        self.recordsBefore = cp.records - cp.fileRecords
+        if self.indexed:
+            path = self.file_name() + recordindex.SUFFIX
+            if os.path.exists(path):
+                self.index = recordindex.IndexWriter(path, self.recordsBefore, cp.offset, cp.fileRecords, resume=True)
+            else:       # the interrupted transfer wasn't indexed, catch up on what it left
+                self.index = recordindex.IndexWriter(path, self.recordsBefore)
+                with open(self.file_name(), "rb") as f:
+                    self.index.add(f.read(cp.offset).replace(b'\r\n', b'\n'))
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.index:
+            self.index.close()
+
+    def finish_file(self, path):
+        """ Hands a closed file to the worker pool for QC and compression """
+        if self.compressor:
+            future = self.compressor.submit(path, stats=self.qc is not None)
+            if self.qc:
+                self.qc.watch(future, lambda result: result[2])
+        elif self.qc:
+            self.qc.submit(path)
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+        if self.index:
+            self.index.flush()
+
+    def start(self):
+        if self.resume:
+            self.reopen_file()
+        else:
+            self.open_file()
+        if self.checked:
+            self.qc = qc.Summary(self.destination, self.curTime)
+        self.thread.start()
+
+    def put(self, item):
+        if self.error:
+            raise self.error
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start = time.monotonic()
+            self.queue.put(item)
+            self.stallTime += time.monotonic() - start
+        depth = self.queue.qsize()
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+        if self.flow:
+            self.flow.check(depth)
+
+    def write(self, data, lines):
+        """ Queues complete '\\n' terminated lines for the current file """
+        self.put((data, lines))
+
+    def rotate(self):
+        """ Queues a switch to the next file """
+        self.put(ROTATE)
+
+    def close(self, compressLast=True):
+        """ Waits for everything queued to reach the disk, then closes the file
+
+            compressLast=False leaves the last file uncompressed and out of
+            the QC summary, for a transfer that is going to be resumed into it.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.thread.is_alive():
+            self.queue.put(CLOSE)
+            self.thread.join()
+        self.close_file()
+        if self.flow:
+            self.flow.close()
+        if compressLast and not self.error and self.files:
+            self.finish_file(self.file_name())
+        if self.compressor:
+            self.compressor.wait()
+        if self.qc:
+            self.qc.wait()
+        logging.info(f"Writer: {self.bytesWritten} bytes in {self.fileCounter + 1} files, "
+                     f"max queue depth {self.maxDepth}/{self.queue.maxsize}, "
+                     f"reader stalled {self.stallTime:.3f}s, rotation {self.rotateTime:.3f}s")
+        if self.error:
+            raise self.error
+
+    def fan_out(self, data, lines):
+        """ Passes the complete records in data on to the sinks, holding back a trailing partial record """
+        total = self.partialLines + lines
+        partial = total % 3
+        if total == partial:
+            self.partial += data
+            self.partialLines = total
+            return
+        cut = len(data)
+        for _ in range(partial + 1):
+            cut = data.rfind(b'\n', 0, cut)
+        chunk = bytes(self.partial + data[:cut + 1]) if self.partial else bytes(data[:cut + 1])
+        self.partial = bytearray(data[cut + 1:])
+        self.partialLines = partial
+        for sink in self.sinks:
+            sink.write(chunk)
+
+    def track(self, data, lines):
+        """ Moves the checkpoint to the end of the last complete record in the data just written """
+        cp = self.checkpoint
+        partial = (self.fileLines + lines) % 3      # lines of an unfinished record at the end of data
+        if lines > partial:
+            pos = len(data)
+            for _ in range(partial + 1):
+                pos = data.rfind(b'\n', 0, pos)
+            cp.offset = self.fileBytes + pos + 1
+            cp.fileRecords = (self.fileLines + lines) // 3
+            cp.records = self.recordsBefore + cp.fileRecords
+            self.dirty = True
+        self.fileLines += lines
+        self.fileBytes += len(data)
+
+    def save_checkpoint(self):
+        self.flush()
+        self.checkpoint.save(self.destination)
+        self.savedAt = time.monotonic()
+        self.dirty = False
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=IDLE_FLUSH)
+                except queue.Empty:
+                    self.flush()
+                    if self.checkpoint and self.dirty:
+                        self.save_checkpoint()
+                    continue
+                if self.flow:
+                    self.flow.check(self.queue.qsize())
+                if item is CLOSE:
+                    if self.checkpoint:
+                        self.save_checkpoint()
+                    break
+                elif item is ROTATE and self.files:
+                    start = time.monotonic()
+                    self.close_file()
+                    self.finish_file(self.file_name())
+                    self.fileCounter += 1
+                    self.open_file()
+                    elapsed = time.monotonic() - start
+                    self.rotateTime += elapsed
+                    self.maxRotate = max(self.maxRotate, elapsed)
+                    if self.checkpoint:
+                        self.recordsBefore += self.fileLines // 3
+                        self.fileLines = self.fileBytes = 0
+                        cp = self.checkpoint
+                        cp.fileCounter, cp.fileRecords, cp.offset = self.fileCounter, 0, 0
+                        self.save_checkpoint()
+                elif item is not ROTATE:
+                    data, lines = item
+                    if self.sinks:
+                        self.fan_out(data, lines)
+                    if not self.files:
+                        continue
+                    if self.index:
+                        self.index.add(data)
+                    data = data.replace(b'\n', b'\r\n')
+                    self.file.write(data)
+                    self.bytesWritten += len(data)
+                    if self.checkpoint:
+                        self.track(data, lines)
+                        if self.dirty and time.monotonic() - self.savedAt >= checkpoint.INTERVAL:
+                            self.save_checkpoint()
+        except Exception as e:
+            self.error = e
+            # keep draining so the reader never blocks on a writer that has died
+            while self.queue.get() is not CLOSE:
+                pass